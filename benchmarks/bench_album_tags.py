@@ -0,0 +1,158 @@
+"""Benchmark of the tag building of a synthetic label run: the album tag
+template (metadata.AlbumTags) computed once per release, against the
+per-track recomputation of every album-level tag it replaced.
+
+    python -m benchmarks.bench_album_tags [--releases N] [--tracks N]
+"""
+import argparse
+import time
+
+import mutagen.id3 as id3
+
+from qobuz_dl_gui.qobuz_dl import metadata
+from qobuz_dl_gui.qobuz_dl.metadata import (
+    ID3_LEGEND,
+    _format_copyright,
+    _format_genres,
+    _get_title,
+)
+
+# the genre list of a release, as the API returns it
+GENRES = [
+    f"Pop/Rock→Rock→Style {i}" if i % 2 else f"Pop/Rock→Genre {i}"
+    for i in range(20)
+]
+
+
+def make_release(number, tracks):
+    album = {
+        "id": str(number),
+        "title": f"Album {number}",
+        "artist": {"name": "Artist"},
+        "label": {"name": "Label"},
+        "genres_list": GENRES,
+        "tracks_count": tracks,
+        "release_date_original": "2020-01-02",
+        "copyright": "(P) 2020 Label (C) 2020 Label",
+    }
+    album["tracks"] = {
+        "items": [
+            {
+                "id": number * 1000 + i,
+                "title": f"Track {i}",
+                "track_number": i,
+                "media_number": 1,
+                "performer": {"name": "Performer"},
+                "composer": {"name": "Composer"},
+            }
+            for i in range(1, tracks + 1)
+        ]
+    }
+    return album
+
+
+def legacy_flac_tags(final_name, d, album):
+    # release variant of _flac_tags before the album tag template
+    tags = dict()
+    tags["TITLE"] = _get_title(d)
+    tags["TRACKNUMBER"] = str(d["track_number"])
+    if "Disc " in final_name:
+        tags["DISCNUMBER"] = str(d["media_number"])
+    try:
+        tags["COMPOSER"] = d["composer"]["name"]
+    except KeyError:
+        pass
+    artist_ = d.get("performer", {}).get("name")
+    tags["ARTIST"] = artist_ or album["artist"]["name"]
+    tags["LABEL"] = album.get("label", {}).get("name", "n/a")
+    tags["GENRE"] = _format_genres(album["genres_list"])
+    tags["ALBUMARTIST"] = album["artist"]["name"]
+    tags["TRACKTOTAL"] = str(album["tracks_count"])
+    tags["ALBUM"] = album["title"]
+    tags["DATE"] = album["release_date_original"]
+    tags["COPYRIGHT"] = _format_copyright(album.get("copyright") or "n/a")
+    return tags
+
+
+def legacy_id3_frames(d, album):
+    # release variant of _id3_frames before the album tag template
+    tags = dict()
+    tags["title"] = _get_title(d)
+    try:
+        tags["label"] = album["label"]["name"]
+    except KeyError:
+        pass
+    artist_ = d.get("performer", {}).get("name")
+    tags["artist"] = artist_ or album["artist"]["name"]
+    tags["genre"] = _format_genres(album["genres_list"])
+    tags["albumartist"] = album["artist"]["name"]
+    tags["album"] = album["title"]
+    tags["date"] = album["release_date_original"]
+    tags["copyright"] = _format_copyright(album["copyright"])
+    tracktotal = str(album["tracks_count"])
+    tags["year"] = tags["date"][:4]
+
+    frames = dict()
+    frames["TRCK"] = id3.TRCK(encoding=3, text=f'{d["track_number"]}/{tracktotal}')
+    frames["TPOS"] = id3.TPOS(encoding=3, text=str(d["media_number"]))
+    for k, v in tags.items():
+        id3tag = ID3_LEGEND[k]
+        frames[id3tag.__name__] = id3tag(encoding=3, text=v)
+    return frames
+
+
+def legacy_run(releases):
+    flac, frames = [], []
+    for album in releases:
+        for d in album["tracks"]["items"]:
+            flac.append(legacy_flac_tags("track.flac", d, album))
+            frames.append(legacy_id3_frames(d, album))
+    return flac, frames
+
+
+def template_run(releases):
+    flac, frames = [], []
+    for album in releases:
+        album_tags = metadata.AlbumTags(None, album, istrack=False)
+        for d in album["tracks"]["items"]:
+            flac.append(metadata._flac_tags("track.flac", d, album, False, album_tags))
+            frames.append(metadata._id3_frames(d, album, False, album_tags))
+    return flac, frames
+
+
+def measure(run, releases, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = run(releases)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--releases", type=int, default=50)
+    parser.add_argument("--tracks", type=int, default=10, help="tracks per release")
+    parser.add_argument("--runs", type=int, default=5, help="best of N runs")
+    args = parser.parse_args()
+
+    releases = [make_release(i, args.tracks) for i in range(args.releases)]
+    legacy, (legacy_flac, legacy_frames) = measure(legacy_run, releases, args.runs)
+    template, (flac, frames) = measure(template_run, releases, args.runs)
+    if flac != legacy_flac or [
+        {name: str(frame) for name, frame in f.items()} for f in frames
+    ] != [{name: str(frame) for name, frame in f.items()} for f in legacy_frames]:
+        raise RuntimeError("The album tag template changed the tags")
+
+    tracks = args.releases * args.tracks
+    print(f"{args.releases} releases of {args.tracks} tracks, best of {args.runs} runs")
+    for name, elapsed in (("per-track", legacy), ("album template", template)):
+        print(
+            f"{name:>15}: {elapsed * 1000:7.1f} ms, "
+            f"{elapsed / tracks * 1e6:6.1f} us per track"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Microbenchmark of the track write path: transfer.copy_response against
+the 1 KiB iter_content loop that tqdm_download used before it.
+
+    python -m benchmarks.bench_copy_response [--size MB] [--runs N]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from tqdm import tqdm
+
+from benchmarks.mock_server import FileHandler, mock_server
+from qobuz_dl_gui.qobuz_dl import transfer
+
+
+def iter_content_loop(response, file, bar):
+    # the loop used before copy_response
+    written = 0
+    for data in response.iter_content(chunk_size=1024):
+        size = file.write(data)
+        bar.update(size)
+        written += size
+    return written
+
+
+def copy_response_loop(response, file, bar):
+    return transfer.copy_response(response, file, bar.update)
+
+
+def measure(copy, url, size, fname):
+    """Downloads `url` once. Returns the wall and CPU seconds it took."""
+    session = transfer.get_session()
+    with open(os.devnull, "w") as devnull:
+        wall, cpu = time.perf_counter(), time.process_time()
+        r = session.get(url, stream=True)
+        with r, open(fname, "wb") as file, tqdm(
+            total=size, unit="iB", unit_scale=True, file=devnull
+        ) as bar:
+            written = copy(r, file, bar)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    if written != size:
+        raise RuntimeError(f"Got {written} bytes instead of {size}")
+    return wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=300, help="file size (MB)")
+    parser.add_argument("--runs", type=int, default=3, help="best of N runs")
+    args = parser.parse_args()
+    size = args.size * 1000 * 1000
+
+    with tempfile.TemporaryDirectory() as tmp, mock_server(
+        FileHandler, size=size
+    ) as url:
+        fname = os.path.join(tmp, "track.tmp")
+        print(f"{args.size} MB file, best of {args.runs} runs")
+        for name, copy in (
+            ("iter_content(1024)", iter_content_loop),
+            ("copy_response", copy_response_loop),
+        ):
+            wall, cpu = min(
+                measure(copy, url + "track.flac", size, fname) for _ in range(args.runs)
+            )
+            print(
+                f"{name:>20}: {wall:6.2f} s wall, {cpu:6.2f} s CPU, "
+                f"{size / wall / 1e6:7.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
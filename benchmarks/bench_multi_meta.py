@@ -0,0 +1,86 @@
+"""Benchmark of qopy.Client.multi_meta, which fetches the pages of an
+artist, label or playlist concurrently, against the sequential page loop
+it replaced. Runs against a local mock of the label/get endpoint.
+
+    python -m benchmarks.bench_multi_meta [--albums N ...] [--latency MS]
+"""
+import argparse
+import time
+
+import requests
+
+from benchmarks.mock_server import LabelHandler, mock_server
+from qobuz_dl_gui.qobuz_dl import qopy
+
+
+class MockClient(qopy.Client):
+    """qopy.Client calling the mock API, without logging in"""
+
+    def __init__(self, base):
+        self.base = base
+        self.id = "0"
+        self.cache = None
+        self.restored = False
+        self.session = requests.Session()
+
+
+def sequential_multi_meta(client, epoint, key, id, type):
+    # the page loop used before the pages were fetched concurrently
+    total = 1
+    offset = 0
+    while total > 0:
+        if type in ["tracks", "albums"]:
+            j = client.api_call(epoint, id=id, offset=offset, type=type)[type]
+        else:
+            j = client.api_call(epoint, id=id, offset=offset, type=type)
+        if offset == 0:
+            yield j
+            total = j[key] - 500
+        else:
+            yield j
+            total -= 500
+        offset += 500
+
+
+def measure(pages, albums):
+    start = time.perf_counter()
+    items = sum(len(page["albums"]["items"]) for page in pages)
+    elapsed = time.perf_counter() - start
+    if items != albums:
+        raise RuntimeError(f"Got {items} albums instead of {albums}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--albums",
+        type=int,
+        nargs="+",
+        default=[2130, 20000],
+        help="albums of the label",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=50, help="API response time (ms)"
+    )
+    args = parser.parse_args()
+
+    print(f"API latency {args.latency:g} ms, {qopy.PAGE_SIZE} albums per page")
+    for albums in args.albums:
+        with mock_server(
+            LabelHandler, albums=albums, latency=args.latency / 1000
+        ) as url:
+            client = MockClient(url)
+            sequential = measure(
+                sequential_multi_meta(client, "label/get", "albums_count", 1, None),
+                albums,
+            )
+            concurrent = measure(client.get_label_meta(1), albums)
+        print(
+            f"{albums:>7} albums: sequential {sequential:6.2f} s, "
+            f"concurrent {concurrent:6.2f} s ({sequential / concurrent:4.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
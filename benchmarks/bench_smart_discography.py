@@ -0,0 +1,134 @@
+"""Checks utils.smart_discography_filter against a fixture set and measures
+how it scales with the size of the discography.
+
+The fixtures (fixtures/discography.json) hold synthetic artist pages and
+the albums the filter chose for them before it was reworked to read every
+page in one linear pass. Each fixture is checked as one page, and split
+across several pages.
+
+    python -m benchmarks.bench_smart_discography [--albums N ...]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import time
+
+from qobuz_dl_gui.qobuz_dl.qopy import PAGE_SIZE
+from qobuz_dl_gui.qobuz_dl.utils import smart_discography_filter
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "discography.json")
+
+ARTIST = "Artist"
+SUFFIXES = [
+    "",
+    "",
+    " (Remastered)",
+    " (2011 Remaster)",
+    " (Deluxe Edition)",
+    " (Live)",
+    " [Expanded]",
+    " (Anniversary Edition)",
+    " (Demo)",
+]
+VERSIONS = [None, None, None, "Remastered", "Deluxe", "Live", "Collector's Edition"]
+QUALITIES = [(16, 44.1), (16, 48.0), (24, 44.1), (24, 48.0), (24, 96.0), (24, 192.0)]
+
+
+def make_albums(count, seed=0, titles=None):
+    """Synthetic albums of a discography, as listed by artist/get. Titles
+    are drawn from `titles` distinct names (default: one per 3 albums).
+    """
+    rng = random.Random(seed)
+    titles = titles or max(count // 3, 1)
+    albums = []
+    for i in range(count):
+        bit_depth, sampling_rate = rng.choice(QUALITIES)
+        albums.append(
+            {
+                "id": f"{seed}-{i}",
+                "title": f"Title {rng.randrange(titles)}{rng.choice(SUFFIXES)}",
+                "version": rng.choice(VERSIONS),
+                "maximum_bit_depth": bit_depth,
+                "maximum_sampling_rate": sampling_rate,
+                "artist": {"name": ARTIST if rng.random() < 0.85 else "Other"},
+            }
+        )
+    return albums
+
+
+def make_pages(albums, page_size=PAGE_SIZE):
+    """Splits `albums` into artist/get pages"""
+    for offset in range(0, max(len(albums), 1), page_size):
+        yield {
+            "name": ARTIST,
+            "albums_count": len(albums),
+            "albums": {
+                "offset": offset,
+                "items": albums[offset : offset + page_size],
+            },
+        }
+
+
+def check(fixtures):
+    """Runs the filter on every fixture. Returns the failed cases."""
+    failed = []
+    for fixture, case in itertools.product(fixtures, range(4)):
+        save_space, skip_extras = bool(case & 2), bool(case & 1)
+        expected = fixture["expected"][case]["ids"]
+        albums = fixture["albums"]
+        for page_size in (len(albums), 7):
+            result = smart_discography_filter(
+                make_pages(albums, page_size), save_space, skip_extras
+            )
+            if [album["id"] for album in result] != expected:
+                failed.append((fixture["name"], save_space, skip_extras, page_size))
+    return failed
+
+
+def measure(albums, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        smart_discography_filter(make_pages(albums), True, True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--albums",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="discography sizes",
+    )
+    parser.add_argument("--runs", type=int, default=3, help="best of N runs")
+    args = parser.parse_args()
+
+    with open(FIXTURES, "r") as f:
+        fixtures = json.load(f)["fixtures"]
+    failed = check(fixtures)
+    for name, save_space, skip_extras, page_size in failed:
+        print(
+            f"FAILED {name} (save_space={save_space}, skip_extras={skip_extras}, "
+            f"{page_size} albums per page)"
+        )
+    print(f"{len(fixtures)} fixtures: {'FAILED' if failed else 'OK'}")
+
+    print(f"best of {args.runs} runs, {PAGE_SIZE} albums per page")
+    for count in args.albums:
+        elapsed = measure(make_albums(count), args.runs)
+        print(
+            f"{count:>7} albums: {elapsed:6.3f} s, "
+            f"{elapsed / count * 1e6:5.2f} us per album"
+        )
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
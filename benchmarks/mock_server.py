@@ -0,0 +1,99 @@
+"""Local HTTP servers standing in for the Qobuz CDN and API in the
+benchmarks. They run in a separate process, so serving the requests
+doesn't count towards the CPU time being measured.
+"""
+import json
+import multiprocessing
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# filler sent by FileHandler, repeated as needed
+BLOCK = bytes(range(256)) * 4096
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    """Serves `size` bytes at any path, like the CDN serves a track"""
+
+    protocol_version = "HTTP/1.1"
+    size = 0
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(self.size))
+        self.end_headers()
+        block = memoryview(BLOCK)
+        remaining = self.size
+        while remaining:
+            sent = self.wfile.write(block[: min(len(block), remaining)])
+            remaining -= sent
+
+    def log_message(self, *args):
+        pass
+
+
+class LabelHandler(BaseHTTPRequestHandler):
+    """Answers label/get like the Qobuz API, for a label with `albums`
+    albums, after `latency` seconds.
+    """
+
+    protocol_version = "HTTP/1.1"
+    albums = 0
+    latency = 0.0
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        query = parse_qs(urlparse(self.path).query)
+        offset = int(query["offset"][0])
+        limit = int(query["limit"][0])
+        body = json.dumps(
+            {
+                "id": query["label_id"][0],
+                "name": "Label",
+                "albums_count": self.albums,
+                "albums": {
+                    "offset": offset,
+                    "limit": limit,
+                    "total": self.albums,
+                    "items": [
+                        {"id": str(i), "title": f"Album {i}"}
+                        for i in range(offset, min(offset + limit, self.albums))
+                    ],
+                },
+            }
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(handler, settings, ready):
+    for name, value in settings.items():
+        setattr(handler, name, value)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+@contextmanager
+def mock_server(handler, **settings):
+    """Runs `handler` on a local HTTP server, with `settings` set as class
+    attributes, and yields the server's base URL.
+    """
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    process = context.Process(
+        target=_serve, args=(handler, settings, ready), daemon=True
+    )
+    process.start()
+    try:
+        yield f"http://127.0.0.1:{ready.get(timeout=30)}/"
+    finally:
+        process.terminate()
+        process.join()
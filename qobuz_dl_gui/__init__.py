@@ -1 +1,6 @@
-from qobuz_dl_gui.gui import main
+def main():
+    # imported here so that the download and tagging modules (also loaded
+    # by worker processes) don't pull in PyQt
+    from qobuz_dl_gui.gui import main
+
+    return main()
@@ -3,6 +3,7 @@ import os
 import logging
 import configparser
 import hashlib
+import multiprocessing
 from pathlib import Path
 
 from PyQt5 import QtWidgets
@@ -11,8 +12,17 @@ from qt_material import apply_stylesheet
 from qobuz_dl_gui.qobuz_dl.bundle import Bundle
 from qobuz_dl_gui.qobuz_dl.color import GREEN, RED, YELLOW
 from qobuz_dl_gui.qobuz_dl.core import QobuzDL
-from qobuz_dl_gui.qobuz_dl.downloader import DEFAULT_FOLDER, DEFAULT_TRACK
-from qobuz_dl_gui.qobuz_dl.exceptions import IneligibleError
+from qobuz_dl_gui.qobuz_dl.downloader import (
+    DEFAULT_FOLDER,
+    DEFAULT_TRACK,
+    DEFAULT_WORKERS,
+    DEFAULT_SEGMENTS,
+)
+from qobuz_dl_gui.qobuz_dl.exceptions import (
+    IneligibleError,
+    InvalidAppIdError,
+    InvalidAppSecretError,
+)
 
 from qobuz_dl_gui.login import Login
 from qobuz_dl_gui.main_view import MainView
@@ -30,6 +40,9 @@ else:
 
 CONFIG_PATH = os.path.join(OS_CONFIG, "qobuz-dl")
 CONFIG_FILE = os.path.join(CONFIG_PATH, "config.ini")
+QOBUZ_CACHE = os.path.join(CONFIG_PATH, "qobuz_dl_cache.db")
+QOBUZ_FILE_CACHE = os.path.join(CONFIG_PATH, "file_cache")
+SESSION_FILE = os.path.join(CONFIG_PATH, "session.json")
 # QOBUZ_DB = os.path.join(CONFIG_PATH, "qobuz_dl.db")
 
 
@@ -55,6 +68,12 @@ def reset_config(config_file):
     config["DEFAULT"]["folder_format"] = DEFAULT_FOLDER
     config["DEFAULT"]["track_format"] = DEFAULT_TRACK
     config["DEFAULT"]["smart_discography"] = "false"
+    config["DEFAULT"]["workers"] = str(DEFAULT_WORKERS)
+    config["DEFAULT"]["segments"] = str(DEFAULT_SEGMENTS)
+    config["DEFAULT"]["stream_tags"] = "false"
+    config["DEFAULT"]["tag_processes"] = "0"
+    config["DEFAULT"]["crc32"] = "false"
+    config["DEFAULT"]["verify_flac"] = "false"
     with open(config_file, "w") as configfile:
         config.write(configfile)
     logging.info(
@@ -95,19 +114,78 @@ def login(config, config_path):
     default_folder = config["DEFAULT"]["default_folder"]
     default_limit = int(config["DEFAULT"]["default_limit"])
     default_quality = int(config["DEFAULT"]["default_quality"])
+    workers = config.getint("DEFAULT", "workers", fallback=DEFAULT_WORKERS)
+    segments = config.getint("DEFAULT", "segments", fallback=DEFAULT_SEGMENTS)
+    stream_tags = config.getboolean("DEFAULT", "stream_tags", fallback=False)
+    tag_processes = config.getint("DEFAULT", "tag_processes", fallback=0)
+    crc32 = config.getboolean("DEFAULT", "crc32", fallback=False)
+    verify_flac = config.getboolean("DEFAULT", "verify_flac", fallback=False)
 
     qobuz = QobuzDL(
         directory=default_folder,
         quality=default_quality,
-        interactive_limit=default_limit)
-    qobuz.get_tokens()
+        interactive_limit=default_limit,
+        workers=workers,
+        segments=segments,
+        stream_tags=stream_tags,
+        tag_processes=tag_processes,
+        crc32=crc32,
+        verify_flac=verify_flac,
+        meta_cache=QOBUZ_CACHE,
+        file_cache=QOBUZ_FILE_CACHE,
+        session_file=SESSION_FILE)
+    # app ID and secrets extracted from the web player's bundle.js are
+    # reused until Qobuz rejects them
+    qobuz.app_id = config["DEFAULT"].get("app_id", "")
+    qobuz.secrets = [
+        secret for secret in config["DEFAULT"].get("secrets", "").split(",") if secret
+    ]
+    # the secret that worked last time
+    secret = config["DEFAULT"].get("secret", "")
+    # when a download finds the stored secrets rejected
+    qobuz.tokens_updated = lambda dl: save_tokens(dl, config, config_path)
+    if not qobuz.app_id or not qobuz.secrets:
+        update_tokens(qobuz, config, config_path)
     try:
-        qobuz.initialize_client(email, password, qobuz.app_id, qobuz.secrets)
+        try:
+            qobuz.initialize_client(
+                email, password, qobuz.app_id, qobuz.secrets, secret)
+        except (InvalidAppIdError, InvalidAppSecretError) as error:
+            logging.info(
+                f"{YELLOW}Stored app credentials were rejected ({error}). "
+                "Getting new tokens. Please wait..."
+            )
+            update_tokens(qobuz, config, config_path)
+            qobuz.initialize_client(email, password, qobuz.app_id, qobuz.secrets)
+        save_secret(config, config_path, qobuz.client.sec)
     except IneligibleError:
         qobuz.dl_eligible = False
     return qobuz
 
 
+def save_secret(config, config_path, secret):
+    if config["DEFAULT"].get("secret") == secret:
+        return
+    config["DEFAULT"]["secret"] = secret
+    with open(config_path, "w") as config_file:
+        config.write(config_file)
+
+
+def update_tokens(qobuz, config, config_path):
+    qobuz.get_tokens()
+    save_tokens(qobuz, config, config_path)
+
+
+def save_tokens(qobuz, config, config_path):
+    config["DEFAULT"]["app_id"] = str(qobuz.app_id)
+    config["DEFAULT"]["secrets"] = ",".join(qobuz.secrets)
+    # probe the new secrets on the next login
+    config["DEFAULT"]["secret"] = ""
+    with open(config_path, "w") as config_file:
+        config.write(config_file)
+    logging.info(f"{GREEN}Tokens updated (bundle {qobuz.bundle_version})")
+
+
 def main():
     path_theme = str(Path(__file__).resolve().with_name("theme.xml"))
 
@@ -126,4 +204,7 @@ def main():
 
 
 if __name__ == '__main__':
+    # the tagging and scanning process pools start this executable again
+    # when it is frozen (PyInstaller)
+    multiprocessing.freeze_support()
     main()
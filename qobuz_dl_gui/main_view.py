@@ -10,6 +10,7 @@ from PyQt5.QtGui import QKeyEvent, QBrush
 from PyQt5 import QtWidgets
 
 from qobuz_dl_gui.qobuz_dl.core import QUALITIES
+from qobuz_dl_gui.qobuz_dl.downloader import log_transfer_stats, run_jobs
 
 from qobuz_dl_gui import model
 from qobuz_dl_gui.model import DownloadStatus
@@ -25,37 +26,38 @@ class DownloadThread(QThread):
         super().__init__()
         self.qobuz = qobuz
         self.urls = urls
-        self.queue = []
 
     def run(self):
-        if not self.urls or not isinstance(self.urls, list):
-            logging.info("Nothing to download")
-        else:
-            self._download_urls()
-        self.all_finished.emit()
+        try:
+            if not self.urls or not isinstance(self.urls, list):
+                logging.info("Nothing to download")
+            else:
+                self._download_urls()
+        except Exception as e:
+            logging.error(f"Download failed: {e}", exc_info=True)
+        finally:
+            self.all_finished.emit()
 
     def _download_urls(self):
         for index in range(len(self.urls)):
-            url_queue = []
-            self.queue.append(url_queue)
-            self._handle_url(self.urls[index], url_queue)
-
-        for index in range(len(self.urls)):
-            interrupt = self.isInterruptionRequested()
-            if interrupt:
+            if self.isInterruptionRequested():
                 break
             self.item_started.emit(index)
-            url_queue = self.queue[index]
-            for item in url_queue:
-                interrupt = self.isInterruptionRequested()
-                if interrupt:
-                    break
-                item()
-            else:
+            # the jobs of each batch of releases run as soon as they are
+            # queued, while the next pages of the URL are fetched
+            self._handle_url(self.urls[index], [])
+            if not self.isInterruptionRequested():
                 self.item_finished.emit(index)
+        log_transfer_stats(logging.DEBUG)
 
     def _handle_url(self, url, queue):
-        self.qobuz.handle_url(url, queue)
+        self.qobuz.handle_url(url, queue, self._run_queue)
+
+    def _run_queue(self, queue):
+        run_jobs(queue, self.qobuz.workers, self.isInterruptionRequested)
+        # finished jobs would keep their release's metadata alive
+        del queue[:]
+        return not self.isInterruptionRequested()
 
 
 class MainView(QtWidgets.QWidget):
@@ -242,6 +244,11 @@ class MainView(QtWidgets.QWidget):
         self.sb_limit.setMaximum(500)
         self.sb_limit.setValue(self.qobuz.interactive_limit)
 
+        self.sb_workers = QtWidgets.QSpinBox()
+        self.sb_workers.setMinimum(1)
+        self.sb_workers.setMaximum(16)
+        self.sb_workers.setValue(self.qobuz.workers)
+
         self.line_dl_dir = QtWidgets.QLineEdit()
         self.line_dl_dir.setText(self.qobuz.directory)
         self.line_dl_dir.setDisabled(True)
@@ -264,10 +271,12 @@ class MainView(QtWidgets.QWidget):
         config_view.addWidget(self.comb_quality, 0, 1)
         config_view.addWidget(QtWidgets.QLabel("Search Limit"), 1, 0)
         config_view.addWidget(self.sb_limit, 1, 1)
-        config_view.addWidget(btn_dl_dir, 2, 0)
-        config_view.addWidget(self.line_dl_dir, 2, 1)
-        config_view.addWidget(btn_save, 3, 0)
-        config_view.addWidget(btn_logout, 3, 1)
+        config_view.addWidget(QtWidgets.QLabel("Parallel Downloads"), 2, 0)
+        config_view.addWidget(self.sb_workers, 2, 1)
+        config_view.addWidget(btn_dl_dir, 3, 0)
+        config_view.addWidget(self.line_dl_dir, 3, 1)
+        config_view.addWidget(btn_save, 4, 0)
+        config_view.addWidget(btn_logout, 4, 1)
         config_view.setRowStretch(config_view.rowCount(), 1)
 
         self.frame_config = QtWidgets.QFrame()
@@ -281,18 +290,23 @@ class MainView(QtWidgets.QWidget):
         dl_dir = self.line_dl_dir.text()
         search_limit = self.sb_limit.value()
         quality = self.comb_quality.currentData()
+        workers = self.sb_workers.value()
 
         self.qobuz.directory = dl_dir
         self.qobuz.interactive_limit = search_limit
+        self.qobuz.workers = workers
         self.quality = quality
 
         self.config["DEFAULT"]["default_folder"] = dl_dir
         self.config["DEFAULT"]["default_limit"] = str(search_limit)
         self.config["DEFAULT"]["default_quality"] = str(quality)
+        self.config["DEFAULT"]["workers"] = str(workers)
         with open(self.config_path, "w") as config_file:
             self.config.write(config_file)
 
     def logout_quit(self):
+        if self.qobuz.session_file and os.path.isfile(self.qobuz.session_file):
+            os.remove(self.qobuz.session_file)
         self.config["DEFAULT"]["email"] = ""
         self.config["DEFAULT"]["password"] = ""
         with open(self.config_path, "w") as config_file:
@@ -407,6 +421,12 @@ class MainView(QtWidgets.QWidget):
 
     def download_finished(self):
         self.dl_in_progress = False
+        # the app secret may have been replaced while downloading
+        secret = self.qobuz.client.sec
+        if self.config["DEFAULT"].get("secret") != secret:
+            self.config["DEFAULT"]["secret"] = secret
+            with open(self.config_path, "w") as config_file:
+                self.config.write(config_file)
 
     def dl_item_started(self, index):
         self.dl_queue[index].status = DownloadStatus.IN_PROGRESS
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+
+import aiohttp
+
+from qobuz_dl_gui.qobuz_dl.qopy import PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# maximum number of API requests in flight at the same time
+DEFAULT_CONNECTIONS = 16
+
+
+class AsyncClient:
+    """asyncio counterpart of `qopy.Client`.
+
+    It reuses the app ID, app secret and user token of an already
+    authenticated `qopy.Client`, and the same request signing, so no extra
+    login is needed. Use it as an async context manager:
+
+    >>> async with AsyncClient(client) as aclient:
+    ...     metas = await aclient.get_album_metas(ids)
+    """
+
+    def __init__(self, client, connections: int = DEFAULT_CONNECTIONS):
+        self.client = client
+        self.connections = connections
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            headers=dict(self.client.session.headers),
+            connector=aiohttp.TCPConnector(limit=self.connections),
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def api_call(self, epoint, **kwargs):
+        params = self.client._get_params(epoint, **kwargs)
+        cache = self.client.cache
+        if cache is not None:
+            cached = cache.get(epoint, params)
+            if cached is not None:
+                return cached
+        # aiohttp only accepts strings and ints as query values
+        query = {k: str(v) for k, v in params.items() if v is not None}
+        async with self.session.get(self.client.base + epoint, params=query) as r:
+            body = await r.json(content_type=None)
+            self.client._check_response(epoint, r.status, lambda: body)
+            r.raise_for_status()
+        if cache is not None:
+            cache.set(epoint, params, body)
+        return body
+
+    async def multi_meta(self, epoint, key, id, type):
+        """Returns every page of a paginated endpoint, in order.
+
+        The first page tells how many items there are; the remaining pages
+        are then requested at once (bounded by the connection limit).
+        """
+
+        async def get_page(offset):
+            j = await self.api_call(epoint, id=id, offset=offset, type=type)
+            return j[type] if type in ["tracks", "albums"] else j
+
+        first = await get_page(0)
+        rest = await asyncio.gather(
+            *(get_page(offset) for offset in range(PAGE_SIZE, first[key], PAGE_SIZE))
+        )
+        return [first, *rest]
+
+    async def get_album_meta(self, id):
+        return await self.api_call("album/get", id=id)
+
+    async def get_track_meta(self, id):
+        return await self.api_call("track/get", id=id)
+
+    async def get_track_url(self, id, fmt_id):
+        return await self.api_call("track/getFileUrl", id=id, fmt_id=fmt_id)
+
+    async def get_artist_meta(self, id):
+        return await self.multi_meta("artist/get", "albums_count", id, None)
+
+    async def get_plist_meta(self, id):
+        return await self.multi_meta("playlist/get", "tracks_count", id, None)
+
+    async def get_label_meta(self, id):
+        return await self.multi_meta("label/get", "albums_count", id, None)
+
+    async def search_albums(self, query, limit):
+        return await self.api_call("album/search", query=query, limit=limit)
+
+    async def search_artists(self, query, limit):
+        return await self.api_call("artist/search", query=query, limit=limit)
+
+    async def search_playlists(self, query, limit):
+        return await self.api_call("playlist/search", query=query, limit=limit)
+
+    async def search_labels(self, query, limit):
+        return await self.api_call("label/search", query=query, limit=limit)
+
+    async def search_tracks(self, query, limit):
+        return await self.api_call("track/search", query=query, limit=limit)
+
+    async def get_album_metas(self, ids):
+        return await self._gather(self.get_album_meta, ids)
+
+    async def get_track_metas(self, ids):
+        return await self._gather(self.get_track_meta, ids)
+
+    async def _gather(self, func, ids):
+        """Calls `func` for every ID at once (bounded by the connection
+        limit). Returns a dict of ID -> result; failed IDs are left out so
+        the caller can retry them one by one.
+        """
+        results = await asyncio.gather(
+            *(func(id) for id in ids), return_exceptions=True
+        )
+        metas = {}
+        for id, result in zip(ids, results):
+            if isinstance(result, Exception):
+                logger.debug(f"Failed to get metadata for {id}: {result}")
+            else:
+                metas[id] = result
+        return metas
+
+
+def get_metas(client, item_type, ids, connections=DEFAULT_CONNECTIONS):
+    """Fetches album or track metadata for many IDs at once from
+    synchronous code.
+
+    :param qopy.Client client: authenticated client
+    :param str item_type: "album" or "track"
+    :param list ids: album or track IDs
+    :param int connections: maximum number of requests in flight
+    :returns: dict of ID -> metadata
+    """
+
+    async def fetch():
+        async with AsyncClient(client, connections) as aclient:
+            if item_type == "album":
+                return await aclient.get_album_metas(ids)
+            return await aclient.get_track_metas(ids)
+
+    return asyncio.run(fetch())
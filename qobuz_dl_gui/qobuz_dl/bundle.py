@@ -19,13 +19,9 @@ _APP_ID_REGEX = re.compile(
     r'production:{api:{appId:"(?P<app_id>\d{9})",appSecret:"\w{32}"'
 )
 
-_BUNDLE_URL_REGEX = re.compile(
-    r'<script src="(/resources/\d+\.\d+\.\d+-[a-z]\d{3}/bundle\.js)"></script>'
-)
-
 _BASE_URL = "https://play.qobuz.com"
 _BUNDLE_URL_REGEX = re.compile(
-    r'<script src="(/resources/\d+\.\d+\.\d+-[a-z]\d{3}/bundle\.js)"></script>'
+    r'<script src="(/resources/(?P<version>\d+\.\d+\.\d+-[a-z]\d{3})/bundle\.js)"></script>'
 )
 
 
@@ -42,6 +38,9 @@ class Bundle:
             raise NotImplementedError("Bundle URL found")
 
         bundle_url = bundle_url_match.group(1)
+        # logged when new credentials are extracted, to tell which bundle
+        # they came from
+        self.version = bundle_url_match.group("version")
 
         logger.debug("Getting bundle")
         response = self._session.get(_BASE_URL + bundle_url)
@@ -0,0 +1,485 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+# seconds a query waits for another process holding the database lock
+BUSY_TIMEOUT = 5
+# access times of cache hits are written together once there are this many
+ACCESS_BATCH = 64
+DEFAULT_FILE_CACHE_SIZE = 1024 * 1024 * 1024
+# seconds a cached file is used without asking the server if it changed
+DEFAULT_FILE_MAX_AGE = 3600
+# ioctl cloning the extents of a file (copy-on-write filesystems on Linux)
+_FICLONE = 0x40049409
+# seconds a response stays valid, per endpoint. Endpoints that aren't
+# listed (in particular the signed track/getFileUrl) are never cached.
+DEFAULT_TTLS = {
+    "album/get": 7 * 24 * 3600,
+    "track/get": 7 * 24 * 3600,
+    "artist/get": 24 * 3600,
+    "label/get": 24 * 3600,
+}
+
+
+class MetaCache:
+    """Size-bounded SQLite cache of API responses, evicted in LRU order.
+
+    :param str path: database file
+    :param int max_size: maximum total size of the stored responses, in bytes
+    :param dict ttls: seconds a response stays valid, per endpoint
+    :param bool bypass: don't read from the cache (fresh responses are
+    still stored)
+
+    The database may be shared by several processes (GUI and CLI); when it
+    is busy, reads count as misses and writes are dropped.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, ttls=None, bypass=False):
+        self.path = path
+        self.max_size = max_size
+        self.ttls = DEFAULT_TTLS if ttls is None else ttls
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> last access time, not written yet
+        self._accessed = {}
+        self._conn = sqlite3.connect(
+            path, timeout=BUSY_TIMEOUT, check_same_thread=False
+        )
+        # readers don't block the writer of another process
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+            """
+        )
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+        atexit.register(self.close)
+
+    @staticmethod
+    def _key(epoint, params) -> str:
+        return epoint + "?" + json.dumps(params, sort_keys=True, default=str)
+
+    def get(self, epoint, params):
+        """Returns the cached response, or None if there is no valid one"""
+        if epoint not in self.ttls or self.bypass:
+            return None
+        key = self._key(epoint, params)
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT body, expires FROM responses WHERE key=?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logger.debug(f"Metadata cache read failed: {e}")
+                row = None
+            if row is None or row[1] < now:
+                self.misses += 1
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_BATCH:
+                self._write_accessed()
+                self._commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, epoint, params, body):
+        if epoint not in self.ttls:
+            return
+        key = self._key(epoint, params)
+        data = json.dumps(body)
+        now = time.time()
+        with self._lock:
+            self._accessed.pop(key, None)
+            try:
+                old = self._conn.execute(
+                    "SELECT size FROM responses WHERE key=?", (key,)
+                ).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                    (key, data, len(data), now + self.ttls[epoint], now),
+                )
+                self._size += len(data) - (old[0] if old else 0)
+                # the LRU order must be up to date before evicting
+                self._write_accessed()
+                self._evict()
+            except sqlite3.Error as e:
+                logger.debug(f"Metadata cache write failed: {e}")
+                self._conn.rollback()
+                self._size = self._total_size()
+                return
+            self._commit()
+
+    def _write_accessed(self):
+        """Writes the pending access times. Must be called with the lock
+        held.
+        """
+        if not self._accessed:
+            return
+        try:
+            self._conn.executemany(
+                "UPDATE responses SET accessed=? WHERE key=?",
+                [(accessed, key) for key, accessed in self._accessed.items()],
+            )
+        except sqlite3.Error as e:
+            # only the LRU order suffers
+            logger.debug(f"Metadata cache write failed: {e}")
+        self._accessed.clear()
+
+    def _commit(self):
+        try:
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.debug(f"Metadata cache write failed: {e}")
+            self._conn.rollback()
+
+    def _total_size(self) -> int:
+        try:
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()[0]
+        except sqlite3.Error:
+            return self._size
+
+    def _evict(self):
+        """Drops expired responses, then the least recently used ones until
+        the cache fits in `max_size`. Must be called with the lock held.
+        """
+        if self._size <= self.max_size:
+            return
+        self._conn.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+        self._size = self._total_size()
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if self._size <= self.max_size:
+                break
+            evicted.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key=?", evicted)
+        logger.debug(f"Evicted {len(evicted)} cached responses")
+
+    def stats(self) -> dict:
+        with self._lock:
+            try:
+                entries = self._conn.execute(
+                    "SELECT COUNT(*) FROM responses"
+                ).fetchone()[0]
+            except sqlite3.Error:
+                entries = None
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "size": self._size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._write_accessed()
+            self._commit()
+            self._conn.close()
+        atexit.unregister(self.close)
+
+
+class FileCache:
+    """Size-bounded local cache of downloaded files such as covers and
+    booklets, evicted in LRU order.
+
+    Entries are keyed by URL, and the files are stored by the SHA-256 of
+    their content, so the same image behind several URLs is kept once.
+    Stale entries are revalidated with ETag/If-Modified-Since, and files
+    are placed with a reflink or a hard link when the filesystem allows it,
+    otherwise copied.
+
+    :param str directory: cache directory
+    :param int max_size: maximum total size of the stored files, in bytes
+    :param int max_age: seconds a file is used without revalidation
+
+    The index may be shared by several processes (GUI and CLI). `fetch`
+    raises sqlite3.Error when it is unusable, so the caller can download
+    the file directly; a file already placed is kept.
+    """
+
+    def __init__(
+        self,
+        directory,
+        max_size=DEFAULT_FILE_CACHE_SIZE,
+        max_age=DEFAULT_FILE_MAX_AGE,
+    ):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self._conn = sqlite3.connect(
+            os.path.join(directory, "index.db"),
+            timeout=BUSY_TIMEOUT,
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                url TEXT PRIMARY KEY,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                etag TEXT,
+                modified TEXT,
+                checked REAL NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed);
+            CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+            """
+        )
+        self._size = self._total_size()
+
+    def _total_size(self) -> int:
+        try:
+            return self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM "
+                "(SELECT DISTINCT digest, size FROM files)"
+            ).fetchone()[0]
+        except sqlite3.Error:
+            return getattr(self, "_size", 0)
+
+    def _object(self, digest) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def fetch(self, url, dest, session):
+        """Places the file at `url` in `dest`, downloading it only if it
+        isn't cached or changed on the server.
+
+        :param str url: file URL
+        :param str dest: destination path (must not exist)
+        :param session: object with a requests-like `get` method
+        """
+        try:
+            self._fetch(url, dest, session)
+        except sqlite3.Error:
+            with self._lock:
+                self._rollback()
+            raise
+
+    def _fetch(self, url, dest, session):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest, size, etag, modified, checked FROM files WHERE url=?",
+                (url,),
+            ).fetchone()
+        # the object may have been changed through a hard link
+        if row is not None and _file_size(self._object(row[0])) != row[1]:
+            row = None
+
+        if row is not None and time.time() - row[4] < self.max_age:
+            digest = row[0]
+            self.hits += 1
+        else:
+            digest = self._download(url, session, row)
+
+        _place(self._object(digest), dest)
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "UPDATE files SET accessed=? WHERE url=?", (time.time(), url)
+                )
+                self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                # the file is in place; only the LRU order and eviction suffer
+                logger.debug(f"Cover/booklet cache write failed: {e}")
+                self._rollback()
+
+    def _rollback(self):
+        """Must be called with the lock held"""
+        try:
+            self._conn.rollback()
+        except sqlite3.Error as e:
+            logger.debug(f"Cover/booklet cache rollback failed: {e}")
+        self._size = self._total_size()
+
+    def _download(self, url, session, row) -> str:
+        """Downloads `url` unless the cached `row` is still valid. Returns
+        the digest of the current file.
+        """
+        headers = {}
+        if row is not None:
+            if row[2]:
+                headers["If-None-Match"] = row[2]
+            if row[3]:
+                headers["If-Modified-Since"] = row[3]
+        try:
+            r = session.get(url, headers=headers, stream=True, timeout=30)
+        except Exception as e:
+            if row is None:
+                raise
+            logger.debug(f"Couldn't revalidate {url}, using the cached file: {e}")
+            self.hits += 1
+            return row[0]
+
+        with r:
+            if r.status_code == 304 and row is not None:
+                with self._lock:
+                    self._conn.execute(
+                        "UPDATE files SET checked=? WHERE url=?", (time.time(), url)
+                    )
+                self.hits += 1
+                return row[0]
+            r.raise_for_status()
+            digest, size = self._store(r)
+
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    digest,
+                    size,
+                    r.headers.get("etag"),
+                    r.headers.get("last-modified"),
+                    now,
+                    now,
+                ),
+            )
+            if row is not None and row[0] != digest:
+                self._release(row[0], row[1])
+            self._size = self._total_size()
+            self._conn.commit()
+        self.misses += 1
+        return digest
+
+    def _store(self, response):
+        """Writes the body of `response` to the object store. Returns its
+        digest and size.
+        """
+        sha = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for data in response.iter_content(chunk_size=64 * 1024):
+                    file.write(data)
+                    sha.update(data)
+                    size += len(data)
+            digest = sha.hexdigest()
+            path = self._object(digest)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return digest, size
+
+    def _release(self, digest, size):
+        """Deletes the object of `digest` once no URL refers to it. Must be
+        called with the lock held.
+        """
+        used = self._conn.execute(
+            "SELECT 1 FROM files WHERE digest=? LIMIT 1", (digest,)
+        ).fetchone()
+        if used:
+            return
+        try:
+            os.remove(self._object(digest))
+        except FileNotFoundError:
+            pass
+        self._size -= size
+
+    def _evict(self):
+        """Drops the least recently used files until the cache fits in
+        `max_size`. Must be called with the lock held.
+        """
+        if self._size <= self.max_size:
+            return
+        rows = self._conn.execute(
+            "SELECT url, digest, size FROM files ORDER BY accessed"
+        ).fetchall()
+        evicted = 0
+        for url, digest, size in rows:
+            if self._size <= self.max_size:
+                break
+            self._conn.execute("DELETE FROM files WHERE url=?", (url,))
+            self._release(digest, size)
+            evicted += 1
+        logger.debug(f"Evicted {evicted} cached files")
+
+    def stats(self) -> dict:
+        with self._lock:
+            try:
+                entries = self._conn.execute(
+                    "SELECT COUNT(*) FROM files"
+                ).fetchone()[0]
+            except sqlite3.Error:
+                entries = None
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": entries,
+                "size": self._size,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def _place(src, dest):
+    """Puts a copy of `src` at `dest`: a reflink if possible, then a hard
+    link, then a plain copy.
+    """
+    tmp = dest + ".part"
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as s, open(tmp, "wb") as d:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            os.replace(tmp, dest)
+            return
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dest)
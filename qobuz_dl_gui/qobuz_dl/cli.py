@@ -5,13 +5,22 @@ import hashlib
 import logging
 import glob
 import os
+import shutil
 import sys
 
 from qobuz_dl_gui.qobuz_dl.bundle import Bundle
 from qobuz_dl_gui.qobuz_dl.color import GREEN, RED, YELLOW
 from qobuz_dl_gui.qobuz_dl.commands import qobuz_dl_args
 from qobuz_dl_gui.qobuz_dl.core import QobuzDL
-from qobuz_dl_gui.qobuz_dl.downloader import DEFAULT_FOLDER, DEFAULT_TRACK
+from qobuz_dl_gui.qobuz_dl.downloader import (
+    DEFAULT_FOLDER,
+    DEFAULT_TRACK,
+    DEFAULT_WORKERS,
+    DEFAULT_SEGMENTS,
+    RESUME_SUFFIX,
+    log_transfer_stats,
+)
+from qobuz_dl_gui.qobuz_dl.library import scan_library
 
 logging.basicConfig(
     level=logging.INFO,
@@ -26,6 +35,9 @@ else:
 CONFIG_PATH = os.path.join(OS_CONFIG, "qobuz-dl")
 CONFIG_FILE = os.path.join(CONFIG_PATH, "config.ini")
 QOBUZ_DB = os.path.join(CONFIG_PATH, "qobuz_dl.db")
+QOBUZ_CACHE = os.path.join(CONFIG_PATH, "qobuz_dl_cache.db")
+QOBUZ_FILE_CACHE = os.path.join(CONFIG_PATH, "file_cache")
+SESSION_FILE = os.path.join(CONFIG_PATH, "session.json")
 
 
 def _reset_config(config_file):
@@ -61,6 +73,13 @@ def _reset_config(config_file):
     config["DEFAULT"]["folder_format"] = DEFAULT_FOLDER
     config["DEFAULT"]["track_format"] = DEFAULT_TRACK
     config["DEFAULT"]["smart_discography"] = "false"
+    config["DEFAULT"]["workers"] = str(DEFAULT_WORKERS)
+    config["DEFAULT"]["segments"] = str(DEFAULT_SEGMENTS)
+    config["DEFAULT"]["stream_tags"] = "false"
+    config["DEFAULT"]["tag_processes"] = "0"
+    config["DEFAULT"]["crc32"] = "false"
+    config["DEFAULT"]["verify_flac"] = "false"
+    config["DEFAULT"]["skip_owned"] = "false"
     with open(config_file, "w") as configfile:
         config.write(configfile)
     logging.info(
@@ -70,15 +89,43 @@ def _reset_config(config_file):
     )
 
 
+def _save_secret(config, secret):
+    if config["DEFAULT"].get("secret") == secret:
+        return
+    config["DEFAULT"]["secret"] = secret
+    with open(CONFIG_FILE, "w") as configfile:
+        config.write(configfile)
+
+
+def _save_tokens(config, qobuz):
+    config["DEFAULT"]["app_id"] = str(qobuz.app_id)
+    config["DEFAULT"]["secrets"] = ",".join(qobuz.secrets)
+    with open(CONFIG_FILE, "w") as configfile:
+        config.write(configfile)
+
+
 def _remove_leftovers(directory):
     directory = os.path.join(directory, "**", ".*.tmp")
     for i in glob.glob(directory, recursive=True):
+        # keep partial downloads that can be resumed on the next run
+        if os.path.isfile(i + RESUME_SUFFIX):
+            continue
         try:
             os.remove(i)
         except:  # noqa
             pass
 
 
+def _remove_database(path):
+    # with its WAL files left behind, SQLite could replay them into a new
+    # database of the same name
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
 def _handle_commands(qobuz, arguments):
     try:
         if arguments.command == "dl":
@@ -99,7 +146,21 @@ def _handle_commands(qobuz, arguments):
         )
 
     finally:
+        if qobuz.downloads_db:
+            qobuz.downloads_db.close()
         _remove_leftovers(qobuz.directory)
+        log_transfer_stats()
+        if qobuz.meta_cache:
+            stats = qobuz.meta_cache.stats()
+            logging.info(
+                f"Metadata cache: {stats['hits']} hits, {stats['misses']} misses"
+            )
+            qobuz.meta_cache.close()
+        if qobuz.file_cache:
+            stats = qobuz.file_cache.stats()
+            logging.info(
+                f"Cover/booklet cache: {stats['hits']} hits, {stats['misses']} misses"
+            )
 
 
 def _initial_checks():
@@ -134,10 +195,19 @@ def main():
         smart_discography = config.getboolean("DEFAULT", "smart_discography")
         folder_format = config["DEFAULT"]["folder_format"]
         track_format = config["DEFAULT"]["track_format"]
+        workers = config.getint("DEFAULT", "workers", fallback=DEFAULT_WORKERS)
+        segments = config.getint("DEFAULT", "segments", fallback=DEFAULT_SEGMENTS)
+        stream_tags = config.getboolean("DEFAULT", "stream_tags", fallback=False)
+        tag_processes = config.getint("DEFAULT", "tag_processes", fallback=0)
+        crc32 = config.getboolean("DEFAULT", "crc32", fallback=False)
+        verify_flac = config.getboolean("DEFAULT", "verify_flac", fallback=False)
+        skip_owned = config.getboolean("DEFAULT", "skip_owned", fallback=False)
 
         secrets = [
             secret for secret in config["DEFAULT"]["secrets"].split(",") if secret
         ]
+        # the secret that worked last time
+        secret = config["DEFAULT"].get("secret", "")
         arguments = qobuz_dl_args(
             default_quality, default_limit, default_folder
         ).parse_args()
@@ -150,21 +220,38 @@ def main():
             )
 
     if arguments.reset:
+        if os.path.isfile(SESSION_FILE):
+            os.remove(SESSION_FILE)
         sys.exit(_reset_config(CONFIG_FILE))
 
     if arguments.show_config:
-        print(f"Configuation: {CONFIG_FILE}\nDatabase: {QOBUZ_DB}\n---")
+        print(
+            f"Configuation: {CONFIG_FILE}\nDatabase: {QOBUZ_DB}\n"
+            f"Metadata cache: {QOBUZ_CACHE}\n"
+            f"Cover/booklet cache: {QOBUZ_FILE_CACHE}\n---"
+        )
         with open(CONFIG_FILE, "r") as f:
             print(f.read())
         sys.exit()
 
     if arguments.purge:
-        try:
-            os.remove(QOBUZ_DB)
-        except FileNotFoundError:
-            pass
+        _remove_database(QOBUZ_DB)
         sys.exit(f"{GREEN}The database was deleted.")
 
+    if arguments.purge_cache:
+        _remove_database(QOBUZ_CACHE)
+        shutil.rmtree(QOBUZ_FILE_CACHE, ignore_errors=True)
+        sys.exit(f"{GREEN}The metadata and cover/booklet caches were deleted.")
+
+    if arguments.command == "scan":
+        stats = scan_library(
+            QOBUZ_DB, arguments.ROOT or [default_folder], arguments.processes
+        )
+        sys.exit(
+            f"{GREEN}Library indexed: {stats['files']} files, {stats['read']} "
+            f"read, {stats['removed']} removed."
+        )
+
     qobuz = QobuzDL(
         arguments.directory,
         arguments.quality,
@@ -178,10 +265,25 @@ def main():
         folder_format=arguments.folder_format or folder_format,
         track_format=arguments.track_format or track_format,
         smart_discography=arguments.smart_discography or smart_discography,
+        workers=arguments.workers or workers,
+        segments=arguments.segments or segments,
+        meta_cache=QOBUZ_CACHE,
+        file_cache=QOBUZ_FILE_CACHE,
+        refresh_meta_cache=arguments.refresh_meta,
+        session_file=SESSION_FILE,
+        stream_tags=arguments.stream_tags or stream_tags,
+        tag_processes=arguments.tag_processes or tag_processes,
+        crc32=arguments.crc32 or crc32,
+        verify_flac=arguments.verify_flac or verify_flac,
+        skip_owned=arguments.skip_owned or skip_owned,
     )
-    qobuz.initialize_client(email, password, app_id, secrets)
+    qobuz.tokens_updated = lambda dl: _save_tokens(config, dl)
+    qobuz.initialize_client(email, password, app_id, secrets, secret)
+    _save_secret(config, qobuz.client.sec)
 
     _handle_commands(qobuz, arguments)
+    # it may have been replaced while downloading
+    _save_secret(config, qobuz.client.sec)
 
 
 if __name__ == "__main__":
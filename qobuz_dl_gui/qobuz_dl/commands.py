@@ -57,6 +57,27 @@ def dl_args(subparsers):
     return download
 
 
+def scan_args(subparsers):
+    scan = subparsers.add_parser(
+        "scan",
+        description="Index the FLAC/MP3 files of a music library, so that "
+        "releases and tracks already owned can be skipped (see --skip-owned).",
+        help="library scan mode",
+    )
+    scan.add_argument(
+        "ROOT",
+        nargs="*",
+        help="folders to scan (default: the download directory)",
+    )
+    scan.add_argument(
+        "--processes",
+        metavar="int",
+        type=int,
+        help="number of processes reading tags (default: number of CPUs)",
+    )
+    return scan
+
+
 def add_common_arg(custom_parser, default_folder, default_quality):
     custom_parser.add_argument(
         "-d",
@@ -104,6 +125,53 @@ def add_common_arg(custom_parser, default_folder, default_quality):
     custom_parser.add_argument(
         "--no-db", action="store_true", help="don't call the database"
     )
+    custom_parser.add_argument(
+        "-w",
+        "--workers",
+        metavar="int",
+        type=int,
+        help="number of tracks of a release downloaded at the same time",
+    )
+    custom_parser.add_argument(
+        "--segments",
+        metavar="int",
+        type=int,
+        help="number of connections used for a single large (hi-res) file",
+    )
+    custom_parser.add_argument(
+        "--stream-tags",
+        action="store_true",
+        help="write tags while downloading instead of rewriting files afterwards",
+    )
+    custom_parser.add_argument(
+        "--tag-processes",
+        metavar="int",
+        type=int,
+        help="tag files in this many worker processes (e.g. the number of CPU "
+        "cores) instead of in threads (default: 0, off)",
+    )
+    custom_parser.add_argument(
+        "--crc32",
+        action="store_true",
+        help="record a CRC32 next to the SHA-256 of every downloaded track",
+    )
+    custom_parser.add_argument(
+        "--verify-flac",
+        action="store_true",
+        help="check downloaded FLAC files against their audio MD5 "
+        "(needs the flac tool)",
+    )
+    custom_parser.add_argument(
+        "--skip-owned",
+        action="store_true",
+        help="skip releases and tracks found by `scan` or already downloaded "
+        "to another folder (matched by Qobuz ID or ISRC)",
+    )
+    custom_parser.add_argument(
+        "--refresh-meta",
+        action="store_true",
+        help="don't use cached album/track/artist/label metadata",
+    )
     custom_parser.add_argument(
         "-ff",
         "--folder-format",
@@ -151,6 +219,11 @@ def qobuz_dl_args(
         action="store_true",
         help="purge/delete downloaded-IDs database",
     )
+    parser.add_argument(
+        "--purge-cache",
+        action="store_true",
+        help="delete the metadata and cover/booklet caches",
+    )
     parser.add_argument(
         "-sc",
         "--show-config",
@@ -167,6 +240,7 @@ def qobuz_dl_args(
     interactive = fun_args(subparsers, default_limit)
     download = dl_args(subparsers)
     lucky = lucky_args(subparsers)
+    scan_args(subparsers)
     [
         add_common_arg(i, default_folder, default_quality)
         for i in (interactive, download, lucky)
@@ -1,5 +1,6 @@
 # Slightly modified version of qobuz-dl, originally written by vitiko98.
 # All credits to the original author.
+import itertools
 import logging
 import os
 import sys
@@ -9,9 +10,14 @@ from bs4 import BeautifulSoup as bso
 from pathvalidate import sanitize_filename
 
 from qobuz_dl_gui.qobuz_dl.bundle import Bundle
-from qobuz_dl_gui.qobuz_dl import downloader, qopy
-from qobuz_dl_gui.qobuz_dl.exceptions import NonStreamable
-from qobuz_dl_gui.qobuz_dl.db import create_db, handle_download_id
+from qobuz_dl_gui.qobuz_dl.cache import FileCache, MetaCache
+from qobuz_dl_gui.qobuz_dl import aqopy, downloader, qopy
+from qobuz_dl_gui.qobuz_dl.exceptions import (
+    CorruptDownloadError,
+    IncompleteDownloadError,
+    NonStreamable,
+)
+from qobuz_dl_gui.qobuz_dl.db import DownloadsDB
 from qobuz_dl_gui.qobuz_dl.utils import (
     get_url_info,
     make_m3u,
@@ -54,6 +60,17 @@ class QobuzDL:
         track_format="{tracknumber}. {tracktitle}",
         smart_discography=False,
         dl_eligible=True,
+        workers=downloader.DEFAULT_WORKERS,
+        segments=downloader.DEFAULT_SEGMENTS,
+        meta_cache=None,
+        refresh_meta_cache=False,
+        session_file=None,
+        stream_tags=False,
+        file_cache=None,
+        tag_processes=0,
+        crc32=False,
+        verify_flac=False,
+        skip_owned=False,
     ):
         self.directory = create_and_return_dir(directory)
         self.quality = quality
@@ -66,25 +83,64 @@ class QobuzDL:
         self.quality_fallback = quality_fallback
         self.cover_og_quality = cover_og_quality
         self.no_cover = no_cover
-        self.downloads_db = create_db(downloads_db) if downloads_db else None
+        self.downloads_db = DownloadsDB(downloads_db) if downloads_db else None
         self.folder_format = folder_format
         self.track_format = track_format
         self.smart_discography = smart_discography
         self.dl_eligible = dl_eligible
-
-    def initialize_client(self, email, pwd, app_id, secrets):
-        self.client = qopy.Client(email, pwd, app_id, secrets)
+        self.workers = workers
+        self.segments = segments
+        self.session_file = session_file
+        self.stream_tags = stream_tags
+        self.tag_processes = tag_processes
+        self.crc32 = crc32
+        self.verify_flac = verify_flac
+        self.skip_owned = skip_owned
+        self.meta_cache = (
+            MetaCache(meta_cache, bypass=refresh_meta_cache) if meta_cache else None
+        )
+        self.file_cache = FileCache(file_cache) if file_cache else None
+        # optional callable receiving this object after `refresh_tokens`,
+        # e.g. to save the new tokens to the config file
+        self.tokens_updated = None
+
+    def initialize_client(self, email, pwd, app_id, secrets, secret=None):
+        self.client = qopy.Client(
+            email,
+            pwd,
+            app_id,
+            secrets,
+            self.meta_cache,
+            secret or None,
+            self.session_file,
+            self.refresh_tokens,
+        )
         logger.info(f"Set max quality: {QUALITIES[int(self.quality)]}\n")
 
     def get_tokens(self):
         bundle = Bundle()
+        self.bundle_version = bundle.version
         self.app_id = bundle.get_app_id()
         self.secrets = [
             secret for secret in bundle.get_secrets().values() if secret
         ]  # avoid empty fields
 
-    def download_from_id(self, item_id, album=True, alt_path=None, queue=None):
-        if handle_download_id(self.downloads_db, item_id, add_id=False):
+    def refresh_tokens(self):
+        """Gets a new app ID and secrets from the web player's bundle, once
+        the client rejected all the stored ones.
+
+        :returns: (app_id, secrets)
+        """
+        logger.info(f"Stored app secrets were rejected. Getting new tokens...")
+        self.get_tokens()
+        if self.tokens_updated is not None:
+            self.tokens_updated(self)
+        return self.app_id, self.secrets
+
+    def download_from_id(
+        self, item_id, album=True, alt_path=None, queue=None, meta=None
+    ):
+        if self.downloads_db is not None and item_id in self.downloads_db:
             logger.info(
                 f"This release ID ({item_id}) was already downloaded "
                 "according to the local database.\nUse the '--no-db' flag "
@@ -104,13 +160,39 @@ class QobuzDL:
                 self.no_cover,
                 self.folder_format,
                 self.track_format,
+                int(self.workers),
+                int(self.segments),
+                meta,
+                self.stream_tags,
+                self.file_cache,
+                int(self.tag_processes),
+                self.downloads_db,
+                self.crc32,
+                self.verify_flac,
+                self.skip_owned,
             )
             dloader.download_id_by_type(not album, queue)
-            handle_download_id(self.downloads_db, item_id, add_id=True)
+            # queued jobs haven't run yet, so only a finished download counts
+            if self.downloads_db is not None and queue is None:
+                self.downloads_db.add(item_id)
+                # don't keep other instances and `scan` waiting on the lock
+                self.downloads_db.flush()
         except (requests.exceptions.RequestException, NonStreamable) as e:
             logger.error(f"Error getting release: {e}. Skipping...")
+        except (IncompleteDownloadError, CorruptDownloadError) as e:
+            logger.error(
+                f"Release {item_id} is incomplete: {e}. It will be resumed "
+                "on the next run."
+            )
+
+    def handle_url(self, url, queue=None, run_queue=None):
+        """Downloads an album, track, playlist, artist or label URL.
 
-    def handle_url(self, url, queue=None):
+        :param list queue: collects the track jobs instead of running them
+        :param run_queue: called with `queue` after each batch of releases
+        so the jobs run while the next pages are fetched; returning False
+        stops the download of the URL
+        """
         possibles = {
             "playlist": {
                 "func": self.client.get_plist_meta,
@@ -136,8 +218,12 @@ class QobuzDL:
             )
             return
         if type_dict["func"]:
-            content = [item for item in type_dict["func"](item_id)]
-            content_name = content[0]["name"]
+            key = type_dict["iterable_key"]
+            # pages are fetched in the background while the ones already
+            # received are downloaded
+            pages = type_dict["func"](item_id)
+            first = next(pages)
+            content_name = first["name"]
             logger.info(
                 f"Downloading all the music from {content_name} "
                 f"({url_type})!"
@@ -149,27 +235,55 @@ class QobuzDL:
             if self.smart_discography and url_type == "artist":
                 # change `save_space` and `skip_extras` for customization
                 items = smart_discography_filter(
-                    content,
+                    itertools.chain([first], pages),
                     save_space=True,
                     skip_extras=True,
                 )
+                logger.info(f"{len(items)} downloads in queue")
+                batches = (
+                    items[i : i + qopy.PAGE_SIZE]
+                    for i in range(0, len(items), qopy.PAGE_SIZE)
+                )
             else:
-                items = [item[type_dict["iterable_key"]]["items"] for item in content][
-                    0
-                ]
-
-            logger.info(f"{len(items)} downloads in queue")
-            for item in items:
-                self.download_from_id(
-                    item["id"],
-                    True if type_dict["iterable_key"] == "albums" else False,
-                    new_path,
-                    queue
+                total = first.get(f"{key}_count", len(first[key]["items"]))
+                logger.info(f"{total} downloads in queue")
+                batches = (
+                    page[key]["items"] for page in itertools.chain([first], pages)
                 )
+
+            is_album = key == "albums"
+            for items in batches:
+                self.download_items(items, is_album, new_path, queue)
+                if run_queue is not None and run_queue(queue) is False:
+                    return
             if url_type == "playlist" and not self.no_m3u_for_playlists:
                 make_m3u(new_path)
         else:
             self.download_from_id(item_id, type_dict["album"], queue=queue)
+            if run_queue is not None:
+                run_queue(queue)
+
+    def download_items(self, items, is_album, path, queue=None):
+        """Downloads a batch of albums or tracks listed by an artist, label
+        or playlist, fetching their metadata at once first.
+        """
+        metas = self.get_metas(
+            "album" if is_album else "track", [item["id"] for item in items]
+        )
+        for item in items:
+            meta = metas.get(item["id"])
+            self.download_from_id(item["id"], is_album, path, queue, meta)
+
+    def get_metas(self, item_type, ids):
+        """Fetches the metadata of many albums or tracks at once, skipping
+        the ones already in the downloads database.
+        """
+        if self.downloads_db is not None:
+            ids = [i for i in ids if i not in self.downloads_db]
+        if not ids:
+            return {}
+        logger.info(f"Getting metadata of {len(ids)} {item_type}s...")
+        return aqopy.get_metas(self.client, item_type, ids)
 
     def download_list_of_urls(self, urls):
         if not urls or not isinstance(urls, list):
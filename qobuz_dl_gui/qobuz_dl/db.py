@@ -1,20 +1,86 @@
 # Slightly modified version of qobuz-dl, originally written by vitiko98.
 # All credits to the original author.
+import atexit
 import logging
+import os
 import sqlite3
+import threading
+import time
 
 from qobuz_dl_gui.qobuz_dl.color import YELLOW, RED
 
 logger = logging.getLogger(__name__)
 
+# pending writes are committed together once there are this many of them,
+# or COMMIT_INTERVAL seconds after the first one
+COMMIT_BATCH = 64
+COMMIT_INTERVAL = 2.0
+
+
+def _migrate_1(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS downloads (id TEXT UNIQUE NOT NULL);")
+
+
+def _migrate_2(conn):
+    # ledger of every downloaded track
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS tracks (
+            path TEXT PRIMARY KEY,
+            track_id TEXT NOT NULL,
+            isrc TEXT,
+            release_id TEXT,
+            format TEXT,
+            bit_depth INTEGER,
+            sampling_rate REAL,
+            size INTEGER,
+            sha256 TEXT,
+            crc32 TEXT,
+            downloaded REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tracks_track_id ON tracks (track_id);
+        CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc);
+        """
+    )
+
+
+def _migrate_3(conn):
+    # audio files found in the local library by `library.scan_library`
+    conn.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS library (
+            path TEXT PRIMARY KEY,
+            mtime REAL NOT NULL,
+            size INTEGER NOT NULL,
+            track_id TEXT,
+            isrc TEXT,
+            format TEXT,
+            bit_depth INTEGER,
+            sampling_rate REAL,
+            scanned REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS library_track_id ON library (track_id);
+        CREATE INDEX IF NOT EXISTS library_isrc ON library (isrc);
+        """
+    )
+
+
+# migration to each schema version, in order (stored in PRAGMA user_version)
+MIGRATIONS = [_migrate_1, _migrate_2, _migrate_3]
+SCHEMA_VERSION = len(MIGRATIONS)
+
 
 def create_db(db_path):
+    """Creates the database, or brings an older one to SCHEMA_VERSION"""
     with sqlite3.connect(db_path) as conn:
-        try:
-            conn.execute("CREATE TABLE downloads (id TEXT UNIQUE NOT NULL);")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0 and not conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='downloads'"
+        ).fetchone():
             logger.info(f"{YELLOW}Download-IDs database created")
-        except sqlite3.OperationalError:
-            pass
+        for number in range(version, SCHEMA_VERSION):
+            MIGRATIONS[number](conn)
+            conn.execute(f"PRAGMA user_version = {number + 1}")
         return db_path
 
 
@@ -39,3 +105,182 @@ def handle_download_id(db_path, item_id, add_id=False):
                 "SELECT id FROM downloads where id=?",
                 (item_id,),
             ).fetchone()
+
+
+class DownloadsDB:
+    """Long-lived handle on the downloads database.
+
+    The IDs already downloaded are loaded in memory when it is opened, so
+    membership checks don't touch the disk. New IDs and tracks are
+    written in WAL mode and committed in groups (see COMMIT_BATCH and
+    COMMIT_INTERVAL), so the write lock is never held longer than
+    COMMIT_INTERVAL; `flush` or `close` commits the rest right away. Every method can
+    be called from several download threads at once.
+
+    :param str path: database file
+    """
+
+    def __init__(self, path):
+        self.path = create_db(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # a crash may lose the last group, but never corrupts the database
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._ids = {
+            row[0] for row in self._conn.execute("SELECT id FROM downloads")
+        }
+        self._pending = 0
+        # commits the pending writes COMMIT_INTERVAL after the first one
+        self._timer = None
+        atexit.register(self.close)
+
+    def __contains__(self, item_id) -> bool:
+        with self._lock:
+            return str(item_id) in self._ids
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ids)
+
+    def add(self, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            if item_id in self._ids:
+                return
+            if self._write(
+                "INSERT OR IGNORE INTO downloads (id) VALUES (?)", (item_id,)
+            ):
+                self._ids.add(item_id)
+
+    def record_track(
+        self,
+        path,
+        track_id,
+        size,
+        sha256,
+        crc32=None,
+        isrc=None,
+        release_id=None,
+        file_format=None,
+        bit_depth=None,
+        sampling_rate=None,
+    ):
+        """Adds a downloaded track to the ledger (replacing the previous
+        entry of the same path). Paths are stored absolute.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._write(
+                "INSERT OR REPLACE INTO tracks VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path,
+                    str(track_id),
+                    isrc,
+                    None if release_id is None else str(release_id),
+                    file_format,
+                    bit_depth,
+                    sampling_rate,
+                    size,
+                    sha256,
+                    crc32,
+                    time.time(),
+                ),
+            )
+
+    def downloaded_paths(self, paths) -> set:
+        """Returns the paths of `paths` that are in the track ledger"""
+        # absolute path -> paths as given
+        given = {}
+        for path in paths:
+            given.setdefault(os.path.abspath(path), []).append(path)
+        paths = list(given)
+        found = set()
+        with self._lock:
+            if self._conn is None:
+                return found
+            # stay below the SQLite limit of bound parameters
+            for start in range(0, len(paths), 500):
+                chunk = paths[start : start + 500]
+                for (path,) in self._conn.execute(
+                    "SELECT path FROM tracks WHERE path IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    chunk,
+                ):
+                    found.update(given[path])
+        return found
+
+    def owns(self, track_id, isrc=None, bit_depth=None, sampling_rate=None) -> bool:
+        """Tells if a track is in the library index or the track ledger,
+        matched by Qobuz ID or ISRC.
+
+        :param int bit_depth: only count FLAC copies of at least this bit
+        depth and `sampling_rate` (kHz)
+        """
+        condition = "(track_id = ? OR isrc = ?)"
+        params = (str(track_id), isrc.upper() if isrc else None)
+        if bit_depth is not None:
+            condition += (
+                " AND format = 'FLAC' AND bit_depth >= ? AND sampling_rate >= ?"
+            )
+            params += (bit_depth, sampling_rate)
+        with self._lock:
+            if self._conn is None:
+                return False
+            return (
+                self._conn.execute(
+                    f"SELECT 1 FROM library WHERE {condition} UNION ALL "
+                    f"SELECT 1 FROM tracks WHERE {condition} LIMIT 1",
+                    params * 2,
+                ).fetchone()
+                is not None
+            )
+
+    def _write(self, query, params) -> bool:
+        """Runs a write in the open transaction and commits the group if it
+        is full, or schedules its commit. Must be called with the lock held.
+
+        :returns: False if the write failed
+        """
+        if self._conn is None:
+            return False
+        try:
+            self._conn.execute(query, params)
+        except sqlite3.Error as e:
+            logger.error(f"{RED}Unexpected DB error: {e}")
+            return False
+        self._pending += 1
+        if self._pending >= COMMIT_BATCH:
+            self._commit()
+        elif self._timer is None:
+            self._timer = threading.Timer(COMMIT_INTERVAL, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+        return True
+
+    def _commit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        try:
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"{RED}Unexpected DB error: {e}")
+        self._pending = 0
+
+    def flush(self):
+        with self._lock:
+            if self._conn is not None:
+                self._commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._commit()
+            self._conn.close()
+            self._conn = None
+        atexit.unregister(self.close)
@@ -1,15 +1,32 @@
 # Slightly modified version of qobuz-dl, originally written by vitiko98.
 # All credits to the original author.
+import functools
+import json
 import logging
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
 from typing import Tuple
 
 import requests
 from pathvalidate import sanitize_filename, sanitize_filepath
 from tqdm import tqdm
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
 
 import qobuz_dl_gui.qobuz_dl.metadata as metadata
-from qobuz_dl_gui.qobuz_dl.exceptions import NonStreamable
+from qobuz_dl_gui.qobuz_dl import transfer
+from qobuz_dl_gui.qobuz_dl.exceptions import (
+    CorruptDownloadError,
+    IncompleteDownloadError,
+    NonStreamable,
+)
 
 QL_DOWNGRADE = "FormatRestrictedByFormatAvailability"
 # used in case of error
@@ -26,6 +43,49 @@ DEFAULT_FORMATS = {
 
 DEFAULT_FOLDER = "{artist} - {album} ({year}) [{bit_depth}B-{sampling_rate}kHz]"
 DEFAULT_TRACK = "{tracknumber}. {tracktitle}"
+# number of tracks of a release downloaded at the same time
+DEFAULT_WORKERS = 4
+# number of connections used for a single large file
+DEFAULT_SEGMENTS = 4
+# jobs ahead of the running ones whose track URL is requested in advance
+DEFAULT_PREFETCH = 2
+# threads tagging downloaded tracks while the next ones download
+DEFAULT_TAGGERS = 2
+# seconds after which a resolved track URL is requested again before use
+URL_MAX_AGE = 10 * 60
+# files smaller than this are always downloaded over a single connection
+SEGMENT_MIN_SIZE = 32 * 1024 * 1024
+
+# partial downloads keep what's needed to continue them in a file with
+# this suffix next to the temp file
+RESUME_SUFFIX = ".resume"
+# how many times a dropped transfer is resumed before giving up
+MAX_RESUME_ATTEMPTS = 3
+# seconds to wait for a connection, and for data on a running transfer,
+# before it counts as interrupted
+TRANSFER_TIMEOUT = (10, 30)
+# bytes requested at once while looking for the end of the metadata header
+HEADER_PROBE_SIZE = 64 * 1024
+# how many times a track that fails verification is downloaded again
+MAX_CORRUPT_RETRIES = 2
+# checksums of the tracks of a release, kept in its folder
+MANIFEST_NAME = ".checksums.json"
+# lowest bit depth and sampling rate (kHz) of an owned copy that satisfies
+# each lossless quality, for tracks offered at least that high
+QUALITY_FLOORS = {6: (16, 44.1), 7: (24, 96.0), 27: (24, 192.0)}
+
+_CONTENT_RANGE_REGEX = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+# what the CDN answers with once a signed URL has expired
+_EXPIRED_URL_CODES = (401, 403, 404, 410)
+_INTERRUPTED_ERRORS = (
+    ConnectionError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.Timeout,
+    # raised by the raw stream read in transfer.copy_response
+    ProtocolError,
+    ReadTimeoutError,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +104,16 @@ class Download:
         no_cover: bool = False,
         folder_format=None,
         track_format=None,
+        workers: int = DEFAULT_WORKERS,
+        segments: int = DEFAULT_SEGMENTS,
+        meta: dict = None,
+        stream_tags: bool = False,
+        file_cache=None,
+        tag_processes: int = 0,
+        downloads_db=None,
+        crc32: bool = False,
+        verify_flac: bool = False,
+        skip_owned: bool = False,
     ):
         self.client = client
         self.item_id = item_id
@@ -56,6 +126,30 @@ class Download:
         self.no_cover = no_cover
         self.folder_format = folder_format or DEFAULT_FOLDER
         self.track_format = track_format or DEFAULT_TRACK
+        self.workers = workers
+        self.segments = segments
+        # album/track metadata already fetched by the caller
+        self.meta = meta
+        # write the tags while downloading instead of saving them afterwards
+        self.stream_tags = stream_tags
+        # cache.FileCache for covers and booklets
+        self.file_cache = file_cache
+        # tag in a pool of worker processes instead of in threads
+        self.tag_processes = tag_processes
+        if tag_processes > 0:
+            get_tag_pool(tag_processes)
+        # DownloadsDB holding the ledger of downloaded tracks
+        self.downloads_db = downloads_db
+        self.crc32 = crc32
+        # check the audio MD5 of FLAC files by decoding them
+        self.verify_flac = verify_flac
+        if verify_flac and shutil.which("flac") is None:
+            logger.warning("The flac tool wasn't found. Skipping the FLAC MD5 check")
+            self.verify_flac = False
+        # skip the tracks already in the library index or the track ledger
+        self.skip_owned = skip_owned and downloads_db is not None
+        # enough pooled connections for every running transfer and segment
+        transfer.get_session(max(workers, 1) * max(segments, 1))
 
     def download_id_by_type(self, track=True, queue=None):
         if not track:
@@ -64,8 +158,7 @@ class Download:
             self.download_track(queue)
 
     def download_release(self, queue=None):
-        count = 0
-        meta = self.client.get_album_meta(self.item_id)
+        meta = self.meta or self.client.get_album_meta(self.item_id)
 
         if not meta.get("streamable"):
             raise NonStreamable("This release is not streamable")
@@ -79,6 +172,11 @@ class Download:
 
         album_title = _get_title(meta)
 
+        album_tracks = meta["tracks"]["items"]
+        if album_tracks and all(self._owned(track) for track in album_tracks):
+            logger.info(f"{album_title} is already in the library")
+            return
+
         format_info = self._get_format(meta)
         file_format, quality_met, bit_depth, sampling_rate = format_info
 
@@ -105,57 +203,84 @@ class Download:
         if self.no_cover:
             logger.info(f"Skipping cover")
         else:
-            _get_extra(meta["image"]["large"], dirn, og_quality=self.cover_og_quality)
+            _get_extra(
+                meta["image"]["large"],
+                dirn,
+                og_quality=self.cover_og_quality,
+                cache=self.file_cache,
+            )
 
         if "goodies" in meta:
             try:
-                _get_extra(meta["goodies"][0]["url"], dirn, "booklet.pdf")
+                _get_extra(
+                    meta["goodies"][0]["url"],
+                    dirn,
+                    "booklet.pdf",
+                    cache=self.file_cache,
+                )
             except:  # noqa
                 pass
         media_numbers = [track["media_number"] for track in meta["tracks"]["items"]]
         is_multiple = True if len([*{*media_numbers}]) > 1 else False
 
-        def create_dl_fn(
-                root_dir,
-                tmp_count,
-                track_url_dict,
-                track_metadata,
-                album_or_track_metadata,
-                is_track,
-                is_mp3,
-                multiple):
-            return lambda: self._download_and_tag(
-                root_dir, tmp_count, track_url_dict, track_metadata,
-                album_or_track_metadata, is_track, is_mp3, multiple)
-
-        for i in meta["tracks"]["items"]:
-            parse = self.client.get_track_url(i["id"], fmt_id=self.quality)
-            if "sample" not in parse and parse["sampling_rate"]:
-                is_mp3 = True if int(self.quality) == 5 else False
-                fn = create_dl_fn(
-                        dirn,
-                        count,
-                        parse,
-                        i,
-                        meta,
-                        False,
-                        is_mp3,
-                        i["media_number"] if is_multiple else None)
-                if queue is not None:
-                    queue.append(fn)
-                else:
-                    fn()
-            else:
-                logger.info(f"Demo. Skipping")
-            count = count + 1
+        is_mp3 = True if int(self.quality) == 5 else False
+        # read or computed once for all the tracks of the release
+        cover = self._get_cover(dirn)
+        album_tags = metadata.AlbumTags(None, meta, istrack=False)
+        jobs = []
+        tracks = [
+            (i, i["media_number"] if is_multiple else None)
+            for i in meta["tracks"]["items"]
+        ]
+        # look for tracks already on disk before resolving any track URL
+        final_files = [
+            self._get_final_file(dirn, i, is_mp3, multiple)
+            for i, multiple in tracks
+        ]
+        existing = self._downloaded(final_files)
+        for (i, multiple), final_file in zip(tracks, final_files):
+            if final_file in existing:
+                logger.info(f"{i.get('title')} was already downloaded")
+                continue
+            if self._owned(i):
+                logger.info(f"{i.get('title')} is already in the library")
+                continue
+            jobs.append(
+                TrackJob(
+                    self,
+                    dirn,
+                    int(i["id"]),
+                    i,
+                    meta,
+                    False,
+                    is_mp3,
+                    multiple,
+                    cover=cover,
+                    album_tags=album_tags,
+                )
+            )
+        if cover is not None:
+            cover.retain(len(jobs))
+        if queue is not None:
+            queue.extend(jobs)
+        else:
+            failed = run_jobs(jobs, self.workers)
+            log_transfer_stats(logging.DEBUG)
+            if failed:
+                raise IncompleteDownloadError(
+                    f"{len(failed)} of {len(jobs)} tracks failed"
+                )
         logger.info(f"Completed")
 
     def download_track(self, queue=None):
         parse = self.client.get_track_url(self.item_id, self.quality)
 
         if "sample" not in parse and parse["sampling_rate"]:
-            meta = self.client.get_track_meta(self.item_id)
+            meta = self.meta or self.client.get_track_meta(self.item_id)
             track_title = _get_title(meta)
+            if self._owned(meta):
+                logger.info(f"{track_title} is already in the library")
+                return
             artist = _safe_get(meta, "performer", "name")
             logger.info(f"\nDownloading: {artist} - {track_title}")
             format_info = self._get_format(meta, is_track_id=True, track_url_dict=parse)
@@ -185,17 +310,23 @@ class Download:
                     meta["album"]["image"]["large"],
                     dirn,
                     og_quality=self.cover_og_quality,
+                    cache=self.file_cache,
                 )
             is_mp3 = True if int(self.quality) == 5 else False
-            fn = lambda: self._download_and_tag(
+            cover = self._get_cover(dirn)
+            if cover is not None:
+                cover.retain()
+            fn = TrackJob(
+                self,
                 dirn,
-                1,
-                parse,
+                int(meta["id"]),
                 meta,
                 meta,
                 True,
                 is_mp3,
-                False)
+                track_url_dict=parse,
+                cover=cover,
+            )
             if queue is not None:
                 queue.append(fn)
             else:
@@ -204,49 +335,189 @@ class Download:
             logger.info(f"Demo. Skipping")
         logger.info(f"Completed")
 
-    def _download_and_tag(
+    def _get_final_file(self, root_dir, track_metadata, is_mp3, multiple=None):
+        """Path of the track once downloaded and tagged"""
+        extension = ".mp3" if is_mp3 else ".flac"
+        if multiple:
+            root_dir = os.path.join(root_dir, f"Disc {multiple}")
+
+        # Determine the filename
+        track_title = track_metadata.get("title")
+        artist = _safe_get(track_metadata, "performer", "name")
+        filename_attr = self._get_filename_attr(artist, track_metadata, track_title)
+
+        # track_format is a format string
+        # e.g. '{tracknumber}. {artist} - {tracktitle}'
+        formatted_path = sanitize_filename(self.track_format.format(**filename_attr))
+        return os.path.join(root_dir, formatted_path)[:250] + extension
+
+    def _owned(self, track) -> bool:
+        """Tells if a track (metadata dictionary) is already in the library
+        index or the track ledger. Lossless qualities only count FLAC copies
+        of at least the requested quality, or of the best one the track is
+        offered in if it is lower.
+        """
+        if not self.skip_owned:
+            return False
+        floor = QUALITY_FLOORS.get(int(self.quality))
+        if floor is None:
+            return self.downloads_db.owns(track["id"], track.get("isrc"))
+        bit_depth, sampling_rate = floor
+        return self.downloads_db.owns(
+            track["id"],
+            track.get("isrc"),
+            min(bit_depth, track.get("maximum_bit_depth") or bit_depth),
+            min(sampling_rate, track.get("maximum_sampling_rate") or sampling_rate),
+        )
+
+    def _downloaded(self, final_files) -> set:
+        """Returns the files of `final_files` that were already downloaded,
+        according to the track ledger or, for the ones it doesn't know, to
+        a listing of their folders.
+        """
+        found = set()
+        if self.downloads_db is not None:
+            found = self.downloads_db.downloaded_paths(final_files)
+        missing = [f for f in final_files if f not in found]
+        if missing:
+            found.update(
+                _list_files({os.path.dirname(f) for f in missing}).intersection(
+                    missing
+                )
+            )
+        return found
+
+    def _get_cover(self, dirn):
+        if not self.embed_art:
+            return None
+        return metadata.CoverArt(os.path.join(dirn, "cover.jpg"))
+
+    def _download_and_tag(self, *args, **kwargs):
+        tag = self._download(*args, **kwargs)
+        if tag is not None:
+            tag()
+
+    def _download(
         self,
         root_dir,
-        tmp_count,
+        tmp_id,
         track_url_dict,
         track_metadata,
         album_or_track_metadata,
         is_track,
         is_mp3,
         multiple=None,
+        cover=None,
+        album_tags=None,
     ):
-        extension = ".mp3" if is_mp3 else ".flac"
-
+        """Downloads a track into its temp file. Returns the callable that
+        tags and renames it, or None if there is nothing left to do.
+        """
         try:
             url = track_url_dict["url"]
         except KeyError:
             logger.info(f"Track not available for download")
             return
 
+        album_dir = root_dir
         if multiple:
             root_dir = os.path.join(root_dir, f"Disc {multiple}")
             os.makedirs(root_dir, exist_ok=True)
 
-        filename = os.path.join(root_dir, f".{tmp_count:02}.tmp")
-
-        # Determine the filename
+        # releases and playlist tracks can share a folder, so the track ID
+        # keeps the temp files of parallel jobs apart
+        filename = os.path.join(root_dir, f".{tmp_id}.tmp")
         track_title = track_metadata.get("title")
-        artist = _safe_get(track_metadata, "performer", "name")
-        filename_attr = self._get_filename_attr(artist, track_metadata, track_title)
-
-        # track_format is a format string
-        # e.g. '{tracknumber}. {artist} - {tracktitle}'
-        formatted_path = sanitize_filename(self.track_format.format(**filename_attr))
-        final_file = os.path.join(root_dir, formatted_path)[:250] + extension
+        final_file = self._get_final_file(album_dir, track_metadata, is_mp3, multiple)
 
+        # the release was checked against the ledger when its jobs were
+        # created; this only catches a file written since
         if os.path.isfile(final_file):
             logger.info(f"{track_title} was already downloaded")
             return
 
-        tqdm_download(url, filename, filename)
-        tag_function = metadata.tag_mp3 if is_mp3 else metadata.tag_flac
-        try:
-            tag_function(
+        tags = None
+        if self.stream_tags:
+            try:
+                tags = metadata.StreamTags(
+                    is_mp3,
+                    root_dir,
+                    final_file,
+                    track_metadata,
+                    album_or_track_metadata,
+                    is_track,
+                    self.embed_art,
+                    cover,
+                    album_tags,
+                )
+            except Exception as e:
+                logger.error(f"Error preparing the tags of {track_title}: {e}")
+
+        checksum = metadata.AudioChecksum(is_mp3, self.crc32)
+        spliced = tqdm_download(
+            url,
+            filename,
+            filename,
+            self.segments,
+            lambda: self.client.get_track_url(
+                track_metadata["id"], fmt_id=self.quality
+            )["url"],
+            tags,
+            checksum,
+        )
+        if spliced:
+            # already tagged
+            tag = functools.partial(os.rename, filename, final_file)
+        else:
+            tag = self._get_tag_function(
+                filename,
+                root_dir,
+                final_file,
+                track_metadata,
+                album_or_track_metadata,
+                is_track,
+                is_mp3,
+                cover,
+                album_tags,
+            )
+        if is_track:
+            release_id = _safe_get(album_or_track_metadata, "album", "id")
+        else:
+            release_id = album_or_track_metadata.get("id")
+        # what the track ledger records besides the path and checksums
+        details = {
+            "isrc": track_metadata.get("isrc"),
+            "release_id": release_id,
+            "file_format": "MP3" if is_mp3 else "FLAC",
+            "bit_depth": track_url_dict.get("bit_depth"),
+            "sampling_rate": track_url_dict.get("sampling_rate"),
+        }
+        return functools.partial(
+            self._finish,
+            tag,
+            filename,
+            final_file,
+            album_dir,
+            track_metadata["id"],
+            is_mp3,
+            checksum,
+            details,
+        )
+
+    def _get_tag_function(
+        self,
+        filename,
+        root_dir,
+        final_file,
+        track_metadata,
+        album_or_track_metadata,
+        is_track,
+        is_mp3,
+        cover,
+        album_tags,
+    ):
+        if self.tag_processes > 0:
+            job = metadata.tag_job(
                 filename,
                 root_dir,
                 final_file,
@@ -254,9 +525,73 @@ class Download:
                 album_or_track_metadata,
                 is_track,
                 self.embed_art,
+                is_mp3,
+                cover,
+                album_tags,
+            )
+            return functools.partial(_tag_in_process, job)
+        tag_function = metadata.tag_mp3 if is_mp3 else metadata.tag_flac
+        return functools.partial(
+            self._tag,
+            tag_function,
+            filename,
+            root_dir,
+            final_file,
+            track_metadata,
+            album_or_track_metadata,
+            is_track,
+            cover=cover,
+            album_tags=album_tags,
+        )
+
+    def _finish(
+        self, tag, filename, final_file, album_dir, track_id, is_mp3, checksum, details
+    ):
+        """Verifies, tags and renames a downloaded track, then records its
+        checksums in the release manifest and the track in the ledger.
+        Returns False if tagging failed.
+
+        :raises CorruptDownloadError: the FLAC MD5 check failed; the temp
+        file is deleted so the track can be downloaded again
+        """
+        if self.verify_flac and not is_mp3 and metadata.check_flac(filename) is False:
+            os.remove(filename)
+            raise CorruptDownloadError(
+                f"{os.path.basename(final_file)} failed the FLAC MD5 check"
+            )
+        tag()
+        if not os.path.isfile(final_file):
+            # tagging failed and was logged
+            return False
+
+        digests = checksum.result()
+        size = os.path.getsize(final_file)
+        _update_manifest(
+            album_dir,
+            os.path.relpath(final_file, album_dir).replace(os.sep, "/"),
+            {"id": str(track_id), "size": size, **digests},
+        )
+        if self.downloads_db is None:
+            return
+        self.downloads_db.record_track(
+            final_file,
+            track_id,
+            size,
+            digests["sha256"],
+            digests.get("crc32"),
+            **details,
+        )
+
+    def _tag(self, tag_function, filename, root_dir, final_file, *args, **kwargs):
+        try:
+            tag_function(
+                filename, root_dir, final_file, *args, self.embed_art, **kwargs
             )
         except Exception as e:
-            logger.error(f"Error tagging the file: {e}", exc_info=True)
+            logger.error(
+                f"Error tagging the file {os.path.basename(final_file)}: {e}",
+                exc_info=True,
+            )
 
     @staticmethod
     def _get_filename_attr(artist, track_metadata, track_title):
@@ -326,26 +661,799 @@ class Download:
             return ("Unknown", quality_met, None, None)
 
 
-def tqdm_download(url, fname, desc):
-    r = requests.get(url, allow_redirects=True, stream=True)
-    total = int(r.headers.get("content-length", 0))
-    download_size = 0
-    with open(fname, "wb") as file, tqdm(
+class TrackJob:
+    """A track waiting in the download queue.
+
+    Only the track metadata and the requested format are kept; the signed
+    URL is requested right before the transfer (or shortly before, by
+    `prefetch`), so it can't expire while the job waits in a long queue.
+    """
+
+    def __init__(
+        self,
+        download,
+        root_dir,
+        tmp_id,
+        track_metadata,
+        album_or_track_metadata,
+        is_track,
+        is_mp3,
+        multiple=None,
+        track_url_dict=None,
+        cover=None,
+        album_tags=None,
+    ):
+        self.download = download
+        self.root_dir = root_dir
+        self.tmp_id = tmp_id
+        # two jobs writing the same file can't run at the same time
+        self.final_file = download._get_final_file(
+            root_dir, track_metadata, is_mp3, multiple
+        )
+        self.track_metadata = track_metadata
+        self.album_or_track_metadata = album_or_track_metadata
+        self.is_track = is_track
+        self.is_mp3 = is_mp3
+        self.multiple = multiple
+        self.cover = cover
+        self.album_tags = album_tags
+        # times the track failed verification and was queued again
+        self.retries = 0
+        self._url_dict = track_url_dict
+        self._resolved_at = time.monotonic() if track_url_dict else None
+        self._lock = threading.Lock()
+
+    def prefetch(self):
+        """Requests the track URL, unless a fresh one is already known"""
+        with self._lock:
+            if (
+                self._url_dict is None
+                or time.monotonic() - self._resolved_at > URL_MAX_AGE
+            ):
+                self._url_dict = self.download.client.get_track_url(
+                    self.track_metadata["id"], fmt_id=self.download.quality
+                )
+                self._resolved_at = time.monotonic()
+            return self._url_dict
+
+    def warm_up(self):
+        """Resolves the track URL and opens a connection to its host, so
+        the transfer can start right away.
+        """
+        parse = self.prefetch()
+        if "url" in parse:
+            transfer.get_session().warm_up(parse["url"])
+
+    def __call__(self):
+        try:
+            tag = self.fetch()
+            if tag is not None and tag() is False:
+                raise IncompleteDownloadError(
+                    f"{_job_title(self)} couldn't be tagged"
+                )
+        finally:
+            self.release()
+
+    def release(self):
+        """Lets go of what the job shares with the rest of its release
+        (cover, album metadata), once it is done for good.
+        """
+        if self.cover is not None:
+            self.cover.release()
+        self.cover = None
+        self.album_tags = None
+        self.album_or_track_metadata = None
+
+    def fetch(self):
+        """Network stage of the job: downloads the track and returns the
+        callable that tags it, or None.
+        """
+        parse = self.prefetch()
+        if "sample" in parse or not parse["sampling_rate"]:
+            logger.info(f"Demo. Skipping")
+            return None
+        return self.download._download(
+            self.root_dir,
+            self.tmp_id,
+            parse,
+            self.track_metadata,
+            self.album_or_track_metadata,
+            self.is_track,
+            self.is_mp3,
+            self.multiple,
+            self.cover,
+            self.album_tags,
+        )
+
+
+def run_jobs(
+    jobs,
+    workers=1,
+    interrupted=None,
+    prefetch=DEFAULT_PREFETCH,
+    taggers=None,
+):
+    """Run download jobs on a bounded pool of worker threads.
+
+    Jobs with a `fetch` method (`TrackJob`) are split in two stages: the
+    download workers only transfer files and hand the tagging (cover
+    embedding, final rename) over to `taggers` threads through a bounded
+    queue, so the next transfer starts while the previous track is tagged.
+    Downloads wait when the taggers fall behind. Errors are logged per job,
+    so one failed track doesn't stop the rest of the release. Tracks that
+    fail verification are queued again, up to MAX_CORRUPT_RETRIES times.
+
+    :param list jobs: callables created by `Download`
+    :param int workers: maximum number of jobs running at the same time
+    :param interrupted: optional callable; once it returns True, jobs that
+    haven't started yet are skipped
+    :param int prefetch: number of jobs, past the running ones, whose track
+    URL is requested in the background
+    :param int taggers: number of tagging threads; by default
+    DEFAULT_TAGGERS, or one per process of the tag pool if there is one
+    :returns: the jobs that failed or were skipped after an interruption
+    """
+    jobs = _unique_jobs(jobs)
+    if taggers is None:
+        taggers = max(DEFAULT_TAGGERS, _tag_pool_size)
+    prefetcher = ThreadPoolExecutor(max_workers=1) if prefetch > 0 else None
+    tag_queue = Queue(maxsize=max(workers, 1) * 2)
+    # jobs to download again, and jobs that failed for good
+    retries = []
+    failed = []
+    retries_lock = threading.Lock()
+
+    def done(job):
+        if hasattr(job, "release"):
+            job.release()
+
+    def fail(job):
+        with retries_lock:
+            failed.append(job)
+        done(job)
+
+    def tag_worker():
+        while True:
+            item = tag_queue.get()
+            if item is None:
+                tag_queue.task_done()
+                return
+            job, tag = item
+            try:
+                if tag() is False:
+                    fail(job)
+                else:
+                    done(job)
+            except CorruptDownloadError as e:
+                if job.retries < MAX_CORRUPT_RETRIES:
+                    job.retries += 1
+                    logger.warning(f"{e}. Downloading it again")
+                    with retries_lock:
+                        retries.append(job)
+                else:
+                    logger.error(f"Error downloading {_job_title(job)}: {e}")
+                    fail(job)
+            except Exception as e:
+                logger.error(f"Error tagging {_job_title(job)}: {e}", exc_info=True)
+                fail(job)
+            finally:
+                tag_queue.task_done()
+
+    def run(batch, index):
+        if interrupted is not None and interrupted():
+            fail(batch[index])
+            return
+        if prefetcher is not None:
+            start = index + max(workers, 1)
+            for job in batch[start:start + prefetch]:
+                if hasattr(job, "warm_up"):
+                    prefetcher.submit(_prefetch, job)
+        job = batch[index]
+        try:
+            if hasattr(job, "fetch"):
+                tag = job.fetch()
+                if tag is not None:
+                    # blocks while the taggers are busy
+                    tag_queue.put((job, tag))
+                else:
+                    done(job)
+            else:
+                job()
+        except Exception as e:
+            logger.error(f"Error downloading {_job_title(job)}: {e}", exc_info=True)
+            fail(job)
+
+    tag_threads = [
+        threading.Thread(target=tag_worker, daemon=True)
+        for _ in range(max(taggers, 1))
+    ]
+    for thread in tag_threads:
+        thread.start()
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        batch = jobs
+        while batch:
+            if pool is None:
+                for index in range(len(batch)):
+                    run(batch, index)
+            else:
+                futures = []
+                try:
+                    futures = [
+                        pool.submit(run, batch, index) for index in range(len(batch))
+                    ]
+                    for future in futures:
+                        future.result()
+                finally:
+                    # on Ctrl-C only the tracks already in progress are finished
+                    for future in futures:
+                        future.cancel()
+            # wait for the verification of everything downloaded so far
+            tag_queue.join()
+            with retries_lock:
+                batch = retries[:]
+                del retries[:]
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+        if prefetcher is not None:
+            prefetcher.shutdown(wait=False)
+        # let the taggers finish what was already downloaded
+        for _ in tag_threads:
+            tag_queue.put(None)
+        for thread in tag_threads:
+            thread.join()
+    return failed
+
+
+_tag_pool = None
+_tag_pool_size = 0
+_tag_pool_lock = threading.Lock()
+
+
+def get_tag_pool(processes=None) -> ProcessPoolExecutor:
+    """Returns the shared pool of tagging processes, creating it with
+    `processes` workers (default: one per CPU core) on first use.
+    """
+    global _tag_pool, _tag_pool_size
+    with _tag_pool_lock:
+        if _tag_pool is None:
+            _tag_pool_size = processes or os.cpu_count() or 1
+            # forking a process with running threads (Qt, downloads) isn't safe
+            _tag_pool = ProcessPoolExecutor(
+                _tag_pool_size, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _tag_pool
+
+
+def _tag_in_process(job):
+    try:
+        get_tag_pool().submit(metadata.run_tag_job, job).result()
+    except Exception as e:
+        logger.error(
+            f"Error tagging the file {os.path.basename(job['final_name'])}: {e}",
+            exc_info=True,
+        )
+
+
+def _unique_jobs(jobs) -> list:
+    """Drops the jobs that write the same file as an earlier one (releases
+    or playlists listing a track twice).
+    """
+    unique = []
+    seen = set()
+    for job in jobs:
+        final_file = getattr(job, "final_file", None)
+        if final_file is not None:
+            final_file = os.path.abspath(final_file)
+            if final_file in seen:
+                logger.info(f"{_job_title(job)} is queued twice. Skipping")
+                if hasattr(job, "release"):
+                    job.release()
+                continue
+            seen.add(final_file)
+        unique.append(job)
+    return unique
+
+
+def _job_title(job) -> str:
+    track_metadata = getattr(job, "track_metadata", None)
+    if track_metadata:
+        return f'"{track_metadata.get("title", "n/a")}"'
+    return "track"
+
+
+def _prefetch(job):
+    try:
+        job.warm_up()
+    except Exception as e:
+        # the job will try again when it starts
+        logger.debug(f"Failed to prefetch track URL: {e}")
+
+
+_bar_positions = set()
+_bar_positions_lock = threading.Lock()
+
+
+@contextmanager
+def _bar_position():
+    """Reserves the lowest terminal line free for a progress bar, so the
+    bars of parallel downloads don't overwrite each other.
+    """
+    with _bar_positions_lock:
+        position = 0
+        while position in _bar_positions:
+            position += 1
+        _bar_positions.add(position)
+    try:
+        yield position
+    finally:
+        with _bar_positions_lock:
+            _bar_positions.discard(position)
+
+
+def tqdm_download(
+    url, fname, desc, segments=1, refresh_url=None, tags=None, checksum=None
+):
+    """Download `url` into `fname`.
+
+    An interrupted download leaves the partial file and a small resume
+    record (URL, expected size and ETag) next to it, and the next call for
+    the same `fname` continues where it stopped.
+
+    :param str url: file URL
+    :param str fname: destination path
+    :param str desc: progress bar description
+    :param int segments: connections used for large files
+    :param refresh_url: optional callable returning a new URL once the
+    current one has expired
+    :param metadata.StreamTags tags: optional tags written into the file
+    header while downloading
+    :param metadata.AudioChecksum checksum: optional checksum fed with the
+    file; computed as it streams when possible, otherwise from the file on
+    disk once it's complete
+    :returns: True if the file was written with `tags`
+    """
+    hashed = False
+    for attempt in range(1, MAX_RESUME_ATTEMPTS + 1):
+        state = _load_resume_state(fname)
+        try:
+            # a partial single-stream file is always continued as such
+            if segments > 1 and (state is None or "pending" in state):
+                url, total, etag = _probe_range(url, refresh_url)
+                if total >= SEGMENT_MIN_SIZE:
+                    spliced, hashed = _segmented_download(
+                        url,
+                        fname,
+                        desc,
+                        total,
+                        etag,
+                        segments,
+                        state,
+                        refresh_url,
+                        tags,
+                        checksum,
+                    )
+                    break
+            url, spliced, hashed = _stream_download(
+                url, fname, desc, state, refresh_url, tags, checksum
+            )
+            break
+        except _INTERRUPTED_ERRORS as e:
+            if attempt == MAX_RESUME_ATTEMPTS:
+                raise ConnectionError(
+                    f"File download was interrupted for {fname}: {e}"
+                ) from e
+            logger.info(
+                f"Download interrupted for {fname}. Resuming "
+                f"({attempt}/{MAX_RESUME_ATTEMPTS - 1})"
+            )
+    _remove_resume_state(fname)
+    if checksum is not None and not hashed:
+        checksum.reset()
+        checksum.update_from_file(fname)
+    return spliced
+
+
+def _stream_download(
+    url, fname, desc, state, refresh_url, tags=None, checksum=None
+):
+    """Downloads `url` over one connection, continuing the partial file
+    described by `state` if possible. Returns the URL used, whether the
+    file was written with `tags` and whether `checksum` was fed all of it.
+    """
+    # offsets are in bytes of the remote file; a spliced header makes the
+    # local one `delta` bytes longer
+    offset = delta = 0
+    headers = {}
+    if state is not None and "pending" not in state:
+        delta = state.get("delta", 0)
+        offset = max(os.path.getsize(fname) - delta, 0)
+        headers["Range"] = f"bytes={offset}-"
+        if state.get("etag"):
+            headers["If-Range"] = state["etag"]
+        if offset and offset == state.get("size"):
+            return url, "delta" in state, False
+
+    r, url = _open_url(url, refresh_url, headers)
+    if offset and r.status_code == 206:
+        match = _CONTENT_RANGE_REGEX.match(r.headers.get("content-range", ""))
+        if not match or int(match.group(1)) != offset:
+            raise ConnectionError(f"Invalid range response for {fname}")
+        logger.info(f"Resuming {fname} from {offset} bytes")
+    else:
+        # not resumable (or the file changed): start over
+        offset = 0
+
+    total = offset + int(r.headers.get("content-length", 0))
+    etag = r.headers.get("etag")
+    spliced = bool(offset) and "delta" in state
+    _save_resume_state(fname, url, total, etag, delta=delta if spliced else None)
+    with _bar_position() as position, open(
+        fname, "ab" if offset else "wb"
+    ) as file, tqdm(
         total=total,
+        initial=offset,
         unit="iB",
         unit_scale=True,
         unit_divisor=1024,
         desc=desc,
         bar_format="{n_fmt}/{total_fmt} /// {desc}",
+        position=position,
+        leave=False,
     ) as bar:
-        for data in r.iter_content(chunk_size=1024):
-            size = file.write(data)
-            bar.update(size)
-            download_size += size
+        writer = output = None
+        if not offset and tags is not None:
+            writer = output = metadata.StreamTagWriter(
+                file,
+                tags,
+                lambda size: _save_resume_state(fname, url, total, etag, delta=size),
+            )
+        if not offset and checksum is not None:
+            checksum.reset()
+            output = metadata.ChecksumWriter(writer or file, checksum)
+        download_size = offset + transfer.copy_response(
+            r, output or file, bar.update
+        )
+        if writer is not None:
+            writer.flush()
+            spliced = writer.spliced
 
     if total != download_size:
         # https://stackoverflow.com/questions/69919912/requests-iter-content-thinks-file-is-complete-but-its-not
         raise ConnectionError("File download was interrupted for " + fname)
+    return url, spliced, not offset and checksum is not None
+
+
+def _open_url(url, refresh_url=None, headers=None):
+    """Starts a streamed GET request, getting a fresh URL from `refresh_url`
+    if the signed one has expired. Returns the response and the URL used.
+    """
+    session = transfer.get_session()
+    r = session.get(
+        url,
+        headers=headers,
+        allow_redirects=True,
+        stream=True,
+        timeout=TRANSFER_TIMEOUT,
+    )
+    if r.status_code in _EXPIRED_URL_CODES and refresh_url is not None:
+        r.close()
+        logger.info("Download URL expired. Getting a new one")
+        url = refresh_url()
+        r = session.get(
+            url,
+            headers=headers,
+            allow_redirects=True,
+            stream=True,
+            timeout=TRANSFER_TIMEOUT,
+        )
+    r.raise_for_status()
+    return r, url
+
+
+def log_transfer_stats(level=logging.INFO):
+    stats = transfer.get_session().stats()
+    logger.log(
+        level,
+        f"Transfer connections: {stats['handshakes']} opened, "
+        f"{stats['reused']} reused for {stats['requests']} requests",
+    )
+
+
+def _probe_range(url, refresh_url=None):
+    """Returns the URL, size and ETag of the file at `url`. The size is 0
+    if the server doesn't accept byte ranges for it.
+    """
+    try:
+        r, url = _open_url(url, refresh_url, {"Range": "bytes=0-0"})
+    except requests.exceptions.HTTPError:
+        return url, 0, None
+    with r:
+        match = _CONTENT_RANGE_REGEX.match(r.headers.get("content-range", ""))
+        if r.status_code != 206 or not match:
+            return url, 0, None
+        return url, int(match.group(3)), r.headers.get("etag")
+
+
+def _segmented_download(
+    url,
+    fname,
+    desc,
+    total,
+    etag,
+    segments,
+    state=None,
+    refresh_url=None,
+    tags=None,
+    checksum=None,
+):
+    """Downloads `total` bytes from `url` over `segments` connections at once.
+
+    Every connection fetches its own byte range and writes it in place into
+    the preallocated file, so no parts have to be joined afterwards. Ranges
+    that are still missing are kept in the resume record. With `tags`, the
+    metadata header is fetched and tagged first, and the ranges after it
+    are written shifted by the size it gained. `checksum` is fed the file
+    in order while the ranges arrive (see `_SegmentHasher`).
+
+    :returns: whether the file was written with `tags`, and whether
+    `checksum` was fed all of it
+    """
+    if (
+        state is not None
+        and state.get("size") == total
+        and state.get("etag") == etag
+        and os.path.getsize(fname) == total + state.get("delta", 0)
+    ):
+        pending = [tuple(byte_range) for byte_range in state["pending"]]
+        delta = state.get("delta")
+        logger.info(f"Resuming {fname}: {len(pending)} segments left")
+    else:
+        start, header, delta = 0, b"", None
+        if tags is not None:
+            spliced = _read_header(url, tags, total, etag, refresh_url)
+            if spliced is not None:
+                start, header = spliced
+                delta = len(header) - start
+        with open(fname, "wb") as file:
+            file.truncate(total + (delta or 0))
+            file.write(header)
+        segment_size = -(-(total - start) // segments)
+        pending = [
+            (begin, min(begin + segment_size, total) - 1)
+            for begin in range(start, total, segment_size)
+        ]
+    _save_resume_state(fname, url, total, etag, pending, delta)
+    lock = threading.Lock()
+    hasher = None
+    if checksum is not None:
+        checksum.reset()
+        hasher = _SegmentHasher(fname, checksum, pending, delta, total)
+
+    with _bar_position() as position, tqdm(
+        total=total,
+        initial=total - sum(end - start + 1 for start, end in pending),
+        unit="iB",
+        unit_scale=True,
+        unit_divisor=1024,
+        desc=desc,
+        bar_format="{n_fmt}/{total_fmt} /// {desc}",
+        position=position,
+        leave=False,
+    ) as bar:
+
+        def fetch(byte_range):
+            start, end = byte_range
+            headers = {"Range": f"bytes={start}-{end}"}
+            if etag:
+                headers["If-Range"] = etag
+            r, _ = _open_url(url, refresh_url, headers)
+            match = _CONTENT_RANGE_REGEX.match(r.headers.get("content-range", ""))
+            if r.status_code != 206 or not match or (
+                (int(match.group(1)), int(match.group(2))) != (start, end)
+            ):
+                raise ConnectionError(f"Invalid range response for {fname}")
+
+            def progress(size):
+                with lock:
+                    bar.update(size)
+                if hasher is not None:
+                    hasher.update(byte_range, size)
+
+            # unbuffered, so the hasher can read back what was reported
+            with open(fname, "r+b", buffering=0) as file:
+                file.seek(start + (delta or 0))
+                download_size = transfer.copy_response(r, file, progress)
+
+            if download_size != end - start + 1:
+                raise ConnectionError(
+                    f"Segment {start}-{end} was interrupted for {fname}"
+                )
+            with lock:
+                pending.remove(byte_range)
+                _save_resume_state(fname, url, total, etag, pending, delta)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as pool:
+                # list() re-raises the first failed segment
+                list(pool.map(fetch, list(pending)))
+        finally:
+            hashed = hasher is not None and hasher.finish()
+
+    if os.path.getsize(fname) != total + (delta or 0):
+        raise ConnectionError("File download was interrupted for " + fname)
+    return delta is not None, hashed
+
+
+class _SegmentHasher:
+    """Feeds a checksum with a file written by parallel range requests,
+    while they run.
+
+    A checksum needs the file in order, so a thread reads back (from the
+    page cache) everything before the first byte still missing, as the
+    ranges report progress. Once the last range is done, only the data
+    reported since the last read is left to hash.
+
+    :param str fname: file being written
+    :param metadata.AudioChecksum checksum: fed from the start of the file
+    :param list pending: byte ranges (remote offsets) still to be written;
+    the rest of the file is already there
+    :param int delta: bytes the local file is longer than the remote one
+    :param int total: size of the remote file
+    """
+
+    def __init__(self, fname, checksum, pending, delta, total):
+        self.fname = fname
+        self.checksum = checksum
+        self._shift = delta or 0
+        self._size = total + self._shift
+        # bytes written so far, per pending range
+        self._written = {tuple(byte_range): 0 for byte_range in pending}
+        self._ranges = sorted(self._written)
+        self._position = 0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, byte_range, size):
+        with self._cond:
+            self._written[tuple(byte_range)] += size
+            self._cond.notify()
+
+    def finish(self) -> bool:
+        """Waits for the thread. Returns True if the whole file was hashed."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+        return self._position == self._size
+
+    def _available(self) -> int:
+        # end of the data written without gaps from the start of the file
+        for start, end in self._ranges:
+            written = self._written[(start, end)]
+            if written < end - start + 1:
+                return start + self._shift + written
+        return self._size
+
+    def _run(self):
+        try:
+            # unbuffered: a read-ahead would keep bytes not written yet
+            with open(self.fname, "rb", buffering=0) as file:
+                while self._position < self._size:
+                    with self._cond:
+                        available = self._available()
+                        while available <= self._position and not self._stopped:
+                            self._cond.wait()
+                            available = self._available()
+                    if available <= self._position:
+                        return
+                    file.seek(self._position)
+                    while self._position < available:
+                        data = file.read(min(available - self._position, 1 << 20))
+                        if not data:
+                            return
+                        self.checksum.update(data)
+                        self._position += len(data)
+        except OSError as e:
+            logger.debug(f"Couldn't hash {self.fname} while downloading: {e}")
+
+
+def _read_header(url, tags, total, etag=None, refresh_url=None):
+    """Fetches the metadata header at the start of the `total` bytes long
+    file at `url` and applies `tags` to it.
+
+    :returns: the size of the original header and the new header, or None
+    if the file can't be tagged this way
+    """
+    data = bytearray()
+    while len(data) < total:
+        end = min(len(data) + HEADER_PROBE_SIZE, total) - 1
+        headers = {"Range": f"bytes={len(data)}-{end}"}
+        if etag:
+            headers["If-Range"] = etag
+        r, url = _open_url(url, refresh_url, headers)
+        with r:
+            if r.status_code != 206 or not r.content:
+                return None
+            data += r.content
+        try:
+            length = tags.header_length(data)
+            if length is not None:
+                return length, tags.build(bytes(data[:length]))
+        except Exception as e:
+            logger.error(f"Error tagging the stream: {e}", exc_info=True)
+            return None
+    return None
+
+
+_manifest_lock = threading.Lock()
+
+
+def _update_manifest(album_dir, name, entry):
+    """Sets the entry of the file `name` in the checksum manifest of the
+    release in `album_dir`.
+    """
+    path = os.path.join(album_dir, MANIFEST_NAME)
+    with _manifest_lock:
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+        manifest[name] = entry
+        # written aside first, so a crash can't leave half a manifest
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+
+def _resume_file(fname) -> str:
+    return fname + RESUME_SUFFIX
+
+
+def _load_resume_state(fname):
+    """Returns the resume record of a partial download, or None if there is
+    nothing to continue.
+    """
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with open(_resume_file(fname)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_resume_state(fname, url, size, etag, pending=None, delta=None):
+    state = {"url": url, "size": size, "etag": etag}
+    if pending is not None:
+        state["pending"] = pending
+    if delta is not None:
+        state["delta"] = delta
+    with open(_resume_file(fname), "w") as f:
+        json.dump(state, f)
+
+
+def _remove_resume_state(fname):
+    try:
+        os.remove(_resume_file(fname))
+    except FileNotFoundError:
+        pass
+
+
+def _list_files(dirs) -> set:
+    """Paths of the files in `dirs`, with a single scan of each directory"""
+    files = set()
+    for dirn in dirs:
+        try:
+            with os.scandir(dirn) as entries:
+                files.update(entry.path for entry in entries if entry.is_file())
+        except OSError:
+            pass
+    return files
 
 
 def _get_description(item: dict, track_title, multiple=None):
@@ -368,16 +1476,21 @@ def _get_title(item_dict):
     return album_title
 
 
-def _get_extra(item, dirn, extra="cover.jpg", og_quality=False):
+def _get_extra(item, dirn, extra="cover.jpg", og_quality=False, cache=None):
     extra_file = os.path.join(dirn, extra)
     if os.path.isfile(extra_file):
         logger.info(f"{extra} was already downloaded")
         return
-    tqdm_download(
-        item.replace("_600.", "_org.") if og_quality else item,
-        extra_file,
-        extra,
-    )
+    url = item.replace("_600.", "_org.") if og_quality else item
+    if cache is not None:
+        try:
+            cache.fetch(url, extra_file, transfer.get_session())
+            return
+        except sqlite3.Error as e:
+            logger.warning(f"The cover/booklet cache is unavailable ({e})")
+            if os.path.isfile(extra_file):
+                return
+    tqdm_download(url, extra_file, extra)
 
 
 def _clean_format_str(folder: str, track: str, file_format: str) -> Tuple[str, str]:
@@ -22,3 +22,11 @@ class InvalidQuality(Exception):
 
 class NonStreamable(Exception):
     pass
+
+
+class CorruptDownloadError(Exception):
+    pass
+
+
+class IncompleteDownloadError(Exception):
+    pass
@@ -0,0 +1,172 @@
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mutagen
+
+from qobuz_dl_gui.qobuz_dl.db import create_db
+from qobuz_dl_gui.qobuz_dl.downloader import MANIFEST_NAME
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (".flac", ".mp3")
+# files sent to a worker process at once, and rows written per transaction
+SCAN_CHUNK = 64
+WRITE_BATCH = 500
+
+
+def read_file(path):
+    """Reads the ISRC and the audio quality of an audio file. Runs in the
+    scanner's worker processes.
+
+    :returns: (isrc, format, bit_depth, sampling_rate); only the format is
+    set if the file can't be read
+    """
+    is_mp3 = path.lower().endswith(".mp3")
+    file_format = "MP3" if is_mp3 else "FLAC"
+    try:
+        audio = mutagen.File(path)
+    except Exception as e:
+        logger.debug(f"Can't read {path}: {e}")
+        audio = None
+    if audio is None:
+        return None, file_format, None, None
+
+    isrc = None
+    tags = audio.tags
+    if tags is not None:
+        if is_mp3:
+            frame = tags.get("TSRC")
+            if frame is not None and frame.text:
+                isrc = str(frame.text[0])
+        elif tags.get("ISRC"):
+            isrc = tags["ISRC"][0]
+    sampling_rate = getattr(audio.info, "sample_rate", None)
+    return (
+        isrc.strip().upper() if isrc else None,
+        file_format,
+        getattr(audio.info, "bits_per_sample", None),
+        sampling_rate / 1000 if sampling_rate else None,
+    )
+
+
+def _walk(root, track_ids):
+    """Yields (path, mtime, size) of every audio file below `root`.
+
+    :param dict track_ids: filled with the path -> track ID mappings found
+    in release manifests
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError as e:
+            logger.debug(f"Can't list {directory}: {e}")
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name == MANIFEST_NAME:
+                    track_ids.update(_read_manifest(directory, entry.path))
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+                    stat = entry.stat()
+                    yield entry.path, stat.st_mtime, stat.st_size
+            except OSError as e:
+                logger.debug(f"Can't read {entry.path}: {e}")
+
+
+def _read_manifest(directory, path) -> dict:
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.debug(f"Invalid manifest {path}: {e}")
+        return {}
+    return {
+        os.path.normpath(os.path.join(directory, name)): str(entry["id"])
+        for name, entry in manifest.items()
+        if isinstance(entry, dict) and "id" in entry
+    }
+
+
+def scan_library(db_path, roots, processes=None):
+    """Indexes the FLAC and MP3 files below `roots` so that releases and
+    tracks already owned can be skipped.
+
+    Only files whose mtime or size changed since the last scan are read;
+    their tags are read in a pool of `processes` worker processes. Qobuz
+    track IDs come from the release manifests and the track ledger.
+    Files that disappeared from the roots are dropped from the index.
+
+    :param str db_path: downloads database
+    :param list roots: folders to scan
+    :param int processes: worker processes (default: number of CPUs)
+    :returns: dict with the number of files seen, read and removed
+    """
+    create_db(db_path)
+    roots = [os.path.abspath(root) for root in roots]
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    known = {
+        path: (mtime, size)
+        for path, mtime, size in conn.execute(
+            "SELECT path, mtime, size FROM library"
+        )
+    }
+    ledger = {
+        os.path.abspath(path): track_id
+        for path, track_id in conn.execute("SELECT path, track_id FROM tracks")
+    }
+
+    seen = set()
+    changed = []
+    track_ids = {}
+    for root in roots:
+        for path, mtime, size in _walk(root, track_ids):
+            seen.add(path)
+            if known.get(path) != (mtime, size):
+                changed.append((path, mtime, size))
+    logger.info(f"{len(seen)} audio files found, {len(changed)} new or changed")
+
+    read = 0
+    if changed:
+        with ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            paths = [path for path, _, _ in changed]
+            rows = []
+            for (path, mtime, size), info in zip(
+                changed, pool.map(read_file, paths, chunksize=SCAN_CHUNK)
+            ):
+                track_id = track_ids.get(os.path.normpath(path)) or ledger.get(path)
+                rows.append((path, mtime, size, track_id, *info, time.time()))
+                if len(rows) >= WRITE_BATCH:
+                    read += _write(conn, rows)
+                    rows = []
+            read += _write(conn, rows)
+
+    removed = [
+        (path,)
+        for path in known
+        if path not in seen
+        and any(path.startswith(os.path.join(root, "")) for root in roots)
+    ]
+    with conn:
+        conn.executemany("DELETE FROM library WHERE path=?", removed)
+    conn.close()
+    return {"files": len(seen), "read": read, "removed": len(removed)}
+
+
+def _write(conn, rows) -> int:
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO library VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    return len(rows)
@@ -3,8 +3,16 @@
 import re
 import os
 import logging
-
-from mutagen.flac import FLAC, Picture
+import hashlib
+import mmap
+import shutil
+import subprocess
+import threading
+import zlib
+from functools import lru_cache
+from io import BytesIO
+
+from mutagen.flac import FLAC, Picture, VCFLACDict
 import mutagen.id3 as id3
 from mutagen.id3 import ID3NoHeaderError
 
@@ -16,6 +24,14 @@ COPYRIGHT, PHON_COPYRIGHT = "\u2117", "\u00a9"
 # if a metadata block exceeds this, mutagen will raise error
 # and the file won't be tagged
 FLAC_MAX_BLOCKSIZE = 16777215
+# covers larger than this are memory-mapped instead of read
+COVER_MMAP_SIZE = 1024 * 1024
+# empty space left after tags spliced into a stream, so they can be edited
+# later without rewriting the audio
+STREAM_PADDING = 64 * 1024
+
+# FLAC metadata block types
+_FLAC_PADDING, _FLAC_VORBIS_COMMENT, _FLAC_PICTURE = 1, 4, 6
 
 ID3_LEGEND = {
     "album": id3.TALB,
@@ -65,110 +81,293 @@ def _format_genres(genres: list) -> str:
     return ", ".join(no_repeats)
 
 
-def _embed_flac_img(root_dir, audio: FLAC):
+def _find_cover(root_dir) -> str:
     emb_image = os.path.join(root_dir, "cover.jpg")
     multi_emb_image = os.path.join(
         os.path.abspath(os.path.join(root_dir, os.pardir)), "cover.jpg"
     )
     if os.path.isfile(emb_image):
-        cover_image = emb_image
-    else:
-        cover_image = multi_emb_image
+        return emb_image
+    return multi_emb_image
 
+
+class CoverArt:
+    """Cover of a release, read once and shared by the tagging of all of
+    its tracks. The FLAC picture and the ID3 frame are built on first use;
+    large files are memory-mapped rather than copied into memory. Once
+    every track that `retain`ed the cover has released it, the loaded
+    image is dropped.
+
+    :param str path: cover image file
+    :param bool use_mmap: memory-map large files, which keeps them open
+    until the image is dropped
+    """
+
+    def __init__(self, path, use_mmap=True):
+        self.path = path
+        self.use_mmap = use_mmap
+        self._data = None
+        self._picture = None
+        self._frame = None
+        # tracks that still need the cover
+        self._users = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dir(cls, root_dir):
+        """Cover in `root_dir`, or in its parent for multi-disc releases"""
+        return cls(_find_cover(root_dir))
+
+    def retain(self, count=1):
+        with self._lock:
+            self._users += count
+
+    def release(self):
+        """Called by each track once it is done with the cover. The image is
+        loaded again if it is used after the last release.
+        """
+        with self._lock:
+            self._users = max(self._users - 1, 0)
+            if not self._users:
+                # a track still being tagged keeps its own reference
+                self._data = self._picture = self._frame = None
+
+    def _load(self):
+        if self._data is None:
+            with open(self.path, "rb") as img:
+                if (
+                    self.use_mmap
+                    and os.fstat(img.fileno()).st_size > COVER_MMAP_SIZE
+                ):
+                    self._data = mmap.mmap(img.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._data = img.read()
+        return self._data
+
+    def flac_picture(self) -> Picture:
+        with self._lock:
+            if self._picture is None:
+                # rest of the metadata still gets embedded
+                # when the image size is too big
+                if os.path.getsize(self.path) > FLAC_MAX_BLOCKSIZE:
+                    raise Exception(
+                        "downloaded cover size too large to embed. "
+                        "turn off `og_cover` to avoid error"
+                    )
+
+                image = Picture()
+                image.type = 3
+                image.mime = "image/jpeg"
+                image.desc = "cover"
+                image.data = self._load()
+                self._picture = image
+            return self._picture
+
+    def id3_frame(self) -> id3.APIC:
+        with self._lock:
+            if self._frame is None:
+                # mutagen only takes bytes here
+                self._frame = id3.APIC(3, "image/jpeg", 3, "", bytes(self._load()))
+            return self._frame
+
+
+def _flac_picture(cover: CoverArt):
+    """Returns the cover as a FLAC picture, or None if it can't be embedded"""
     try:
-        # rest of the metadata still gets embedded
-        # when the image size is too big
-        if os.path.getsize(cover_image) > FLAC_MAX_BLOCKSIZE:
-            raise Exception(
-                "downloaded cover size too large to embed. "
-                "turn off `og_cover` to avoid error"
-            )
-
-        image = Picture()
-        image.type = 3
-        image.mime = "image/jpeg"
-        image.desc = "cover"
-        with open(cover_image, "rb") as img:
-            image.data = img.read()
-        audio.add_picture(image)
+        return cover.flac_picture()
     except Exception as e:
         logger.error(f"Error embedding image: {e}", exc_info=True)
 
 
-def _embed_id3_img(root_dir, audio: id3.ID3):
-    emb_image = os.path.join(root_dir, "cover.jpg")
-    multi_emb_image = os.path.join(
-        os.path.abspath(os.path.join(root_dir, os.pardir)), "cover.jpg"
-    )
-    if os.path.isfile(emb_image):
-        cover_image = emb_image
-    else:
-        cover_image = multi_emb_image
+def _embed_flac_img(cover: CoverArt, audio: FLAC):
+    image = _flac_picture(cover)
+    if image is not None:
+        audio.add_picture(image)
 
-    with open(cover_image, "rb") as cover:
-        audio.add(id3.APIC(3, "image/jpeg", 3, "", cover.read()))
 
+def _embed_id3_img(cover: CoverArt, audio: id3.ID3):
+    audio.add(cover.id3_frame())
 
-# Use KeyError catching instead of dict.get to avoid empty tags
-def tag_flac(
-    filename, root_dir, final_name, d: dict, album, istrack=True, em_image=False
-):
-    """
-    Tag a FLAC file
 
-    :param str filename: FLAC file path
-    :param str root_dir: Root dir used to get the cover art
-    :param str final_name: Final name of the FLAC file (complete path)
-    :param dict d: Track dictionary from Qobuz_client
+class AlbumTags:
+    """Album-level tags of a release, computed once and shared by all of
+    its tracks, which only add their own fields on top.
+
+    :param dict d: Track dictionary from Qobuz_client, needed if istrack
     :param dict album: Album dictionary from Qobuz_client
     :param bool istrack
-    :param bool em_image: Embed cover art into file
     """
-    audio = FLAC(filename)
 
-    audio["TITLE"] = _get_title(d)
+    def __init__(self, d, album, istrack=True):
+        self.d = d
+        self.album = album
+        self.istrack = istrack
+        # fallback of the track artist
+        self.artist = (d["album"] if istrack else album)["artist"]["name"]
+        self._flac = None
+        self._id3 = None
+
+    # Use KeyError catching instead of dict.get to avoid empty tags
+    def flac(self) -> dict:
+        """Vorbis comments following the track ones, in the order they are
+        written
+        """
+        if self._flac is None:
+            d, album = self.d, self.album
+            tags = dict()
+            tags["LABEL"] = album.get("label", {}).get("name", "n/a")
+
+            if self.istrack:
+                tags["GENRE"] = _format_genres(d["album"]["genres_list"])
+                tags["ALBUMARTIST"] = d["album"]["artist"]["name"]
+                tags["TRACKTOTAL"] = str(d["album"]["tracks_count"])
+                tags["ALBUM"] = d["album"]["title"]
+                tags["DATE"] = d["album"]["release_date_original"]
+                tags["COPYRIGHT"] = _format_copyright(d.get("copyright") or "n/a")
+            else:
+                tags["GENRE"] = _format_genres(album["genres_list"])
+                tags["ALBUMARTIST"] = album["artist"]["name"]
+                tags["TRACKTOTAL"] = str(album["tracks_count"])
+                tags["ALBUM"] = album["title"]
+                tags["DATE"] = album["release_date_original"]
+                tags["COPYRIGHT"] = _format_copyright(album.get("copyright") or "n/a")
+            self._flac = tags
+        return self._flac
+
+    def id3(self):
+        """Returns the track total, the label frames (written before the
+        track artist) and the other album frames, by frame name.
+        """
+        if self._id3 is None:
+            d, album = self.d, self.album
+            # temporarily holds metadata
+            tags = dict()
+            if self.istrack:
+                tags["genre"] = _format_genres(d["album"]["genres_list"])
+                tags["albumartist"] = d["album"]["artist"]["name"]
+                tags["album"] = d["album"]["title"]
+                tags["date"] = d["album"]["release_date_original"]
+                tags["copyright"] = _format_copyright(d["copyright"])
+                tracktotal = str(d["album"]["tracks_count"])
+            else:
+                tags["genre"] = _format_genres(album["genres_list"])
+                tags["albumartist"] = album["artist"]["name"]
+                tags["album"] = album["title"]
+                tags["date"] = album["release_date_original"]
+                tags["copyright"] = _format_copyright(album["copyright"])
+                tracktotal = str(album["tracks_count"])
+
+            tags["year"] = tags["date"][:4]
+
+            label = dict()
+            try:
+                label["TPUB"] = id3.TPUB(encoding=3, text=album["label"]["name"])
+            except KeyError:
+                pass
+            frames = dict()
+            for k, v in tags.items():
+                id3tag = ID3_LEGEND[k]
+                frames[id3tag.__name__] = id3tag(encoding=3, text=v)
+            self._id3 = (tracktotal, label, frames)
+        return self._id3
+
+
+def _flac_tags(final_name, d: dict, album, istrack=True, album_tags=None) -> dict:
+    """Vorbis comments of a track, in the order they are written"""
+    album_tags = album_tags or AlbumTags(d, album, istrack)
+    tags = dict()
+    tags["TITLE"] = _get_title(d)
 
-    audio["TRACKNUMBER"] = str(d["track_number"])  # TRACK NUMBER
+    tags["TRACKNUMBER"] = str(d["track_number"])  # TRACK NUMBER
 
     if "Disc " in final_name:
-        audio["DISCNUMBER"] = str(d["media_number"])
+        tags["DISCNUMBER"] = str(d["media_number"])
 
     try:
-        audio["COMPOSER"] = d["composer"]["name"]  # COMPOSER
+        tags["COMPOSER"] = d["composer"]["name"]  # COMPOSER
     except KeyError:
         pass
 
     artist_ = d.get("performer", {}).get("name")  # TRACK ARTIST
-    if istrack:
-        audio["ARTIST"] = artist_ or d["album"]["artist"]["name"]  # TRACK ARTIST
-    else:
-        audio["ARTIST"] = artist_ or album["artist"]["name"]
+    tags["ARTIST"] = artist_ or album_tags.artist
 
-    audio["LABEL"] = album.get("label", {}).get("name", "n/a")
+    tags.update(album_tags.flac())
+    return tags
 
-    if istrack:
-        audio["GENRE"] = _format_genres(d["album"]["genres_list"])
-        audio["ALBUMARTIST"] = d["album"]["artist"]["name"]
-        audio["TRACKTOTAL"] = str(d["album"]["tracks_count"])
-        audio["ALBUM"] = d["album"]["title"]
-        audio["DATE"] = d["album"]["release_date_original"]
-        audio["COPYRIGHT"] = _format_copyright(d.get("copyright") or "n/a")
-    else:
-        audio["GENRE"] = _format_genres(album["genres_list"])
-        audio["ALBUMARTIST"] = album["artist"]["name"]
-        audio["TRACKTOTAL"] = str(album["tracks_count"])
-        audio["ALBUM"] = album["title"]
-        audio["DATE"] = album["release_date_original"]
-        audio["COPYRIGHT"] = _format_copyright(album.get("copyright") or "n/a")
 
-    if em_image:
-        _embed_flac_img(root_dir, audio)
+def tag_flac(
+    filename,
+    root_dir,
+    final_name,
+    d: dict,
+    album,
+    istrack=True,
+    em_image=False,
+    cover=None,
+    album_tags=None,
+):
+    """
+    Tag a FLAC file
+
+    :param str filename: FLAC file path
+    :param str root_dir: Root dir used to get the cover art
+    :param str final_name: Final name of the FLAC file (complete path)
+    :param dict d: Track dictionary from Qobuz_client
+    :param dict album: Album dictionary from Qobuz_client
+    :param bool istrack
+    :param bool em_image: Embed cover art into file
+    :param CoverArt cover: Cover to embed instead of the one in `root_dir`
+    :param AlbumTags album_tags: Precomputed album tags of the release
+    """
+    _save_flac(
+        filename,
+        final_name,
+        _flac_tags(final_name, d, album, istrack, album_tags),
+        (cover or CoverArt.from_dir(root_dir)) if em_image else None,
+    )
+
+
+def _save_flac(filename, final_name, tags: dict, cover=None):
+    audio = FLAC(filename)
+    for key, value in tags.items():
+        audio[key] = value
+
+    if cover is not None:
+        _embed_flac_img(cover, audio)
 
     audio.save()
     os.rename(filename, final_name)
 
 
-def tag_mp3(filename, root_dir, final_name, d, album, istrack=True, em_image=False):
+def _id3_frames(d, album, istrack=True, album_tags=None) -> dict:
+    """ID3 frames of a track, by frame name"""
+    album_tags = album_tags or AlbumTags(d, album, istrack)
+    tracktotal, label, album_frames = album_tags.id3()
+
+    frames = dict()
+    frames["TRCK"] = id3.TRCK(encoding=3, text=f'{d["track_number"]}/{tracktotal}')
+    frames["TPOS"] = id3.TPOS(encoding=3, text=str(d["media_number"]))
+    frames["TIT2"] = id3.TIT2(encoding=3, text=_get_title(d))
+    frames.update(label)
+
+    artist_ = d.get("performer", {}).get("name")  # TRACK ARTIST
+    frames["TPE1"] = id3.TPE1(encoding=3, text=artist_ or album_tags.artist)
+
+    frames.update(album_frames)
+    return frames
+
+
+def tag_mp3(
+    filename,
+    root_dir,
+    final_name,
+    d,
+    album,
+    istrack=True,
+    em_image=False,
+    cover=None,
+    album_tags=None,
+):
     """
     Tag an mp3 file
 
@@ -178,54 +377,359 @@ def tag_mp3(filename, root_dir, final_name, d, album, istrack=True, em_image=Fal
     :param dict d: Track dictionary from Qobuz_client
     :param bool istrack
     :param bool em_image: Embed cover art into file
+    :param CoverArt cover: Cover to embed instead of the one in `root_dir`
+    :param AlbumTags album_tags: Precomputed album tags of the release
     """
+    _save_mp3(
+        filename,
+        final_name,
+        _id3_frames(d, album, istrack, album_tags),
+        (cover or CoverArt.from_dir(root_dir)) if em_image else None,
+    )
 
+
+def _save_mp3(filename, final_name, frames: dict, cover=None):
     try:
         audio = id3.ID3(filename)
     except ID3NoHeaderError:
         audio = id3.ID3()
 
-    # temporarily holds metadata
-    tags = dict()
-    tags["title"] = _get_title(d)
-    try:
-        tags["label"] = album["label"]["name"]
-    except KeyError:
-        pass
+    for name, frame in frames.items():
+        audio[name] = frame
 
-    artist_ = d.get("performer", {}).get("name")  # TRACK ARTIST
-    if istrack:
-        tags["artist"] = artist_ or d["album"]["artist"]["name"]  # TRACK ARTIST
+    if cover is not None:
+        _embed_id3_img(cover, audio)
+
+    audio.save(filename, "v2_version=3")
+    os.rename(filename, final_name)
+
+
+def tag_job(
+    filename,
+    root_dir,
+    final_name,
+    d,
+    album,
+    istrack=True,
+    em_image=False,
+    is_mp3=False,
+    cover=None,
+    album_tags=None,
+) -> dict:
+    """Describes the tagging done by `tag_flac`/`tag_mp3` as a small
+    picklable dict (paths and tag values only), so `run_tag_job` can do it
+    in another process. Takes the same parameters, plus:
+
+    :param bool is_mp3: tag an mp3 file instead of a FLAC file
+    """
+    if em_image:
+        cover = cover or CoverArt.from_dir(root_dir)
+    if is_mp3:
+        # all text frames
+        frames = _id3_frames(d, album, istrack, album_tags)
+        tags = {name: list(frame.text) for name, frame in frames.items()}
     else:
-        tags["artist"] = artist_ or album["artist"]["name"]
-
-    if istrack:
-        tags["genre"] = _format_genres(d["album"]["genres_list"])
-        tags["albumartist"] = d["album"]["artist"]["name"]
-        tags["album"] = d["album"]["title"]
-        tags["date"] = d["album"]["release_date_original"]
-        tags["copyright"] = _format_copyright(d["copyright"])
-        tracktotal = str(d["album"]["tracks_count"])
+        tags = _flac_tags(final_name, d, album, istrack, album_tags)
+    return {
+        "filename": filename,
+        "final_name": final_name,
+        "is_mp3": is_mp3,
+        "tags": tags,
+        "cover": cover.path if em_image else None,
+    }
+
+
+@lru_cache(maxsize=8)
+def _cached_cover(path) -> CoverArt:
+    # tracks of a release share their cover within a worker process. The
+    # cache outlives the release, so the file is read rather than mapped,
+    # which would keep it open (and locked on Windows)
+    return CoverArt(path, use_mmap=False)
+
+
+def run_tag_job(job: dict):
+    """Tags and renames a file as described by `tag_job`"""
+    cover = _cached_cover(job["cover"]) if job["cover"] else None
+    if job["is_mp3"]:
+        frames = {
+            name: getattr(id3, name)(encoding=3, text=text)
+            for name, text in job["tags"].items()
+        }
+        _save_mp3(job["filename"], job["final_name"], frames, cover)
     else:
-        tags["genre"] = _format_genres(album["genres_list"])
-        tags["albumartist"] = album["artist"]["name"]
-        tags["album"] = album["title"]
-        tags["date"] = album["release_date_original"]
-        tags["copyright"] = _format_copyright(album["copyright"])
-        tracktotal = str(album["tracks_count"])
+        _save_flac(job["filename"], job["final_name"], job["tags"], cover)
 
-    tags["year"] = tags["date"][:4]
 
-    audio["TRCK"] = id3.TRCK(encoding=3, text=f'{d["track_number"]}/{tracktotal}')
-    audio["TPOS"] = id3.TPOS(encoding=3, text=str(d["media_number"]))
+def header_length(data, is_mp3=False) -> int:
+    """Returns the size of the metadata header (FLAC metadata blocks or
+    ID3v2 tag) at the start of `data`, or None if more data is needed to
+    tell.
 
-    # write metadata in `tags` to file
-    for k, v in tags.items():
-        id3tag = ID3_LEGEND[k]
-        audio[id3tag.__name__] = id3tag(encoding=3, text=v)
+    :raises ValueError: `data` doesn't start like a FLAC file
+    """
+    if is_mp3:
+        if len(data) < 10:
+            return None
+        if data[:3] != b"ID3":
+            return 0
+        # syncsafe integer: 7 bits per byte
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        length = 10 + size + (10 if data[5] & 0x10 else 0)
+        return length if len(data) >= length else None
+
+    if len(data) < 4:
+        return None
+    if data[:4] != b"fLaC":
+        raise ValueError("not a FLAC stream")
+    pos = 4
+    while len(data) >= pos + 4:
+        last = data[pos] & 0x80
+        pos += 4 + int.from_bytes(data[pos + 1 : pos + 4], "big")
+        if last:
+            return pos if len(data) >= pos else None
+    return None
+
+
+class StreamTags:
+    """Tags of a track built before its transfer, so they can be spliced
+    into the file as it is written instead of saved afterwards (which
+    rewrites the whole file once the header outgrows its padding).
+
+    It gets the same tags, and cover, as `tag_flac`/`tag_mp3`.
+
+    :param bool is_mp3: the stream is an mp3 file, otherwise FLAC
+    :param str root_dir: Root dir used to get the cover art
+    :param str final_name: Final name of the file (complete path)
+    :param dict d: Track dictionary from Qobuz_client
+    :param dict album: Album dictionary from Qobuz_client
+    :param bool istrack
+    :param bool em_image: Embed cover art into file
+    :param CoverArt cover: Cover to embed instead of the one in `root_dir`
+    :param AlbumTags album_tags: Precomputed album tags of the release
+    """
 
-    if em_image:
-        _embed_id3_img(root_dir, audio)
+    def __init__(
+        self,
+        is_mp3,
+        root_dir,
+        final_name,
+        d,
+        album,
+        istrack=True,
+        em_image=False,
+        cover=None,
+        album_tags=None,
+    ):
+        self.is_mp3 = is_mp3
+        self.picture = None
+        if em_image:
+            cover = cover or CoverArt.from_dir(root_dir)
+        if is_mp3:
+            self.tags = _id3_frames(d, album, istrack, album_tags)
+            if em_image:
+                self.picture = cover.id3_frame()
+        else:
+            self.tags = _flac_tags(final_name, d, album, istrack, album_tags)
+            if em_image:
+                self.picture = _flac_picture(cover)
+
+    def header_length(self, data) -> int:
+        return header_length(data, self.is_mp3)
+
+    def build(self, header) -> bytes:
+        """Returns `header`, the metadata found at the start of the stream,
+        with the tags applied and STREAM_PADDING bytes of padding.
+        """
+        if self.is_mp3:
+            try:
+                audio = id3.ID3(BytesIO(header)) if header else id3.ID3()
+            except ID3NoHeaderError:
+                audio = id3.ID3()
+            for name, frame in self.tags.items():
+                audio[name] = frame
+            if self.picture is not None:
+                audio.add(self.picture)
+            out = BytesIO()
+            audio.save(out, v2_version=4, padding=lambda info: STREAM_PADDING)
+            return out.getvalue()
+
+        blocks = []
+        comments = None
+        pos = 4
+        while pos < len(header):
+            kind = header[pos] & 0x7F
+            size = int.from_bytes(header[pos + 1 : pos + 4], "big")
+            data = header[pos + 4 : pos + 4 + size]
+            pos += 4 + size
+            if kind == _FLAC_VORBIS_COMMENT:
+                comments = VCFLACDict(data, framing=False)
+            elif kind != _FLAC_PADDING:
+                blocks.append((kind, data))
+        if comments is None:
+            comments = VCFLACDict()
+        for key, value in self.tags.items():
+            comments[key] = value
+        blocks.append((_FLAC_VORBIS_COMMENT, comments.write(framing=False)))
+        if self.picture is not None:
+            blocks.append((_FLAC_PICTURE, self.picture.write()))
+        blocks.append((_FLAC_PADDING, bytes(STREAM_PADDING)))
+
+        out = bytearray(b"fLaC")
+        for index, (kind, data) in enumerate(blocks):
+            if len(data) > FLAC_MAX_BLOCKSIZE:
+                raise ValueError(f"metadata block too large: {len(data)} bytes")
+            last = 0x80 if index == len(blocks) - 1 else 0
+            out.append(kind | last)
+            out += len(data).to_bytes(3, "big")
+            out += data
+        return bytes(out)
+
+
+class StreamTagWriter:
+    """Binary file wrapper that replaces the metadata header at the start
+    of a FLAC or mp3 stream with the one built by `StreamTags`.
+
+    Data is held back until the whole original header has arrived, then
+    written with the new header in front; everything after it goes straight
+    through. If the stream can't be tagged, it's written untouched and
+    `spliced` stays False. `write` returns the number of stream bytes
+    consumed, not written.
+
+    :param file: binary file object
+    :param StreamTags tags: tags to splice in
+    :param on_header: optional callable taking the size difference between
+    the new and the original header, called before the header is written
+    """
 
-    audio.save(filename, "v2_version=3")
-    os.rename(filename, final_name)
+    def __init__(self, file, tags: StreamTags, on_header=None):
+        self.file = file
+        self.tags = tags
+        self.on_header = on_header
+        self.spliced = False
+        self._buffer = bytearray()
+
+    def write(self, data) -> int:
+        if self._buffer is None:
+            self.file.write(data)
+            return len(data)
+        self._buffer += data
+        try:
+            length = self.tags.header_length(self._buffer)
+            if length is None:
+                return len(data)
+            header = self.tags.build(bytes(self._buffer[:length]))
+        except Exception as e:
+            logger.error(f"Error tagging the stream: {e}", exc_info=True)
+            self.flush()
+            return len(data)
+
+        if self.on_header is not None:
+            self.on_header(len(header) - length)
+        self.file.write(header)
+        self.file.write(self._buffer[length:])
+        self._buffer = None
+        self.spliced = True
+        return len(data)
+
+    def flush(self):
+        """Writes out whatever is still held back, untouched"""
+        if self._buffer is not None:
+            self.file.write(self._buffer)
+            self._buffer = None
+
+
+class AudioChecksum:
+    """SHA-256 (and optionally CRC32) of the audio data of a FLAC or mp3
+    file, that is everything after the metadata header, so it stays the
+    same however the file is tagged.
+
+    Feed it the file from the start with `update`, either while it streams
+    in or from disk with `update_from_file`.
+
+    :param bool is_mp3: the data is an mp3 file, otherwise FLAC
+    :param bool crc32: also compute a CRC32
+    """
+
+    def __init__(self, is_mp3=False, crc32=False):
+        self.is_mp3 = is_mp3
+        self.crc32 = crc32
+        self.reset()
+
+    def reset(self):
+        """Starts over from the beginning of the file"""
+        self._sha256 = hashlib.sha256()
+        self._crc32 = 0 if self.crc32 else None
+        # start of the file, until the end of its header is known
+        self._head = bytearray()
+
+    def update(self, data):
+        if self._head is not None:
+            self._head += data
+            try:
+                length = header_length(self._head, self.is_mp3)
+            except ValueError:
+                length = 0
+            if length is None:
+                return
+            data = bytes(self._head[length:])
+            self._head = None
+        self._digest(data)
+
+    def _digest(self, data):
+        self._sha256.update(data)
+        if self._crc32 is not None:
+            self._crc32 = zlib.crc32(data, self._crc32)
+
+    def update_from_file(self, path):
+        with open(path, "rb") as file:
+            for data in iter(lambda: file.read(1024 * 1024), b""):
+                self.update(data)
+
+    def result(self) -> dict:
+        """Returns the hex digests by algorithm name"""
+        if self._head is not None:
+            # shorter than its header claims: hash it all
+            self._digest(bytes(self._head))
+            self._head = None
+        result = {"sha256": self._sha256.hexdigest()}
+        if self._crc32 is not None:
+            result["crc32"] = f"{self._crc32:08x}"
+        return result
+
+
+class ChecksumWriter:
+    """Binary file wrapper feeding everything written to an `AudioChecksum`
+
+    :param file: binary file object
+    :param AudioChecksum checksum
+    """
+
+    def __init__(self, file, checksum: AudioChecksum):
+        self.file = file
+        self.checksum = checksum
+
+    def write(self, data) -> int:
+        self.checksum.update(data)
+        return self.file.write(data)
+
+
+def check_flac(path):
+    """Decodes a FLAC file with the reference `flac` tool, which compares
+    the audio with the MD5 stored in its STREAMINFO block.
+
+    :returns: True if the file is intact, False if it's corrupt, None if
+    there is no decoder to check it with
+    """
+    decoder = shutil.which("flac")
+    if decoder is None:
+        return None
+    process = subprocess.run(
+        [decoder, "--test", "--silent", path],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    if process.returncode:
+        logger.debug(f"flac --test failed for {path}: {process.stderr.decode()}")
+    return process.returncode == 0
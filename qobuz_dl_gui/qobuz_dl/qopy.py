@@ -1,8 +1,13 @@
 # Slightly modified version of qobuz-dl, originally written by vitiko98.
 # All credits to the original author.
 import hashlib
+import json
 import logging
+import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
@@ -15,14 +20,33 @@ from qobuz_dl_gui.qobuz_dl.exceptions import (
 )
 
 RESET = "Reset your credentials with 'qobuz-dl -r'"
+# items returned per page by the paginated endpoints
+PAGE_SIZE = 500
+# maximum number of pages fetched at the same time by multi_meta
+PAGE_WORKERS = 8
 
 logger = logging.getLogger(__name__)
 
 
 class Client:
-    def __init__(self, email, pwd, app_id, secrets):
+    def __init__(
+        self,
+        email,
+        pwd,
+        app_id,
+        secrets,
+        cache=None,
+        secret=None,
+        session_file=None,
+        refresh_secrets=None,
+    ):
         logger.info(f"Logging...")
         self.secrets = secrets
+        # optional callable returning a new (app_id, secrets) pair, used once
+        # none of the known secrets is accepted any more
+        self.refresh_secrets = refresh_secrets
+        # optional cache.MetaCache for metadata responses
+        self.cache = cache
         self.id = str(app_id)
         self.session = requests.Session()
         self.session.headers.update(
@@ -34,12 +58,54 @@ class Client:
             }
         )
         self.base = "https://www.qobuz.com/api.json/0.2/"
-        self.sec = None
-        self.auth(email, pwd)
-        self.cfg_setup()
+        # a secret that worked last time is used without probing; it is
+        # only checked once a track URL is requested
+        self.sec = secret
+        self.sec_verified = False
+        self._sec_lock = threading.Lock()
+        # user token saved by a previous run, see `load_session`
+        self.session_file = session_file
+        # True while using a token from `session_file`
+        self.restored = False
+        self._email, self._pwd = email, pwd
+        self._auth_lock = threading.Lock()
+        if not self.load_session():
+            self.auth(email, pwd)
+        if self.sec is None:
+            self.cfg_setup()
 
     def api_call(self, epoint, **kwargs):
-        if epoint == "user/login":
+        params = self._get_params(epoint, **kwargs)
+        if self.cache is not None:
+            cached = self.cache.get(epoint, params)
+            if cached is not None:
+                return cached
+        uat = getattr(self, "uat", None)
+        r = self.session.get(self.base + epoint, params=params)
+        if r.status_code == 401 and epoint != "user/login" and self.restored:
+            # the saved token has expired: log in again and retry once
+            with self._auth_lock:
+                if self.uat == uat:
+                    logger.info(f"Saved session expired. Logging in again...")
+                    self.auth(self._email, self._pwd)
+            params = self._get_params(epoint, **kwargs)
+            r = self.session.get(self.base + epoint, params=params)
+        self._check_response(epoint, r.status_code, r.json)
+        r.raise_for_status()
+        body = r.json()
+        if self.cache is not None:
+            self.cache.set(epoint, params, body)
+        return body
+
+    def _get_params(self, epoint, **kwargs):
+        """Builds (and signs, where needed) the query parameters of a call"""
+        if epoint == "user/login" and "uat" in kwargs:
+            params = {
+                "user_id": kwargs["user_id"],
+                "user_auth_token": kwargs["uat"],
+                "app_id": self.id,
+            }
+        elif epoint == "user/login":
             params = {
                 "email": kwargs["email"],
                 "password": kwargs["pwd"],
@@ -102,47 +168,114 @@ class Client:
             }
         else:
             params = kwargs
-        r = self.session.get(self.base + epoint, params=params)
+        return params
+
+    @staticmethod
+    def _check_response(epoint, status_code, get_json):
+        """Raises the matching exception for login and signature errors.
+
+        :param str epoint: endpoint that was called
+        :param int status_code: HTTP status of the response
+        :param get_json: callable returning the decoded response body
+        """
         if epoint == "user/login":
-            if r.status_code == 401:
+            if status_code == 401:
                 raise AuthenticationError("Invalid credentials.\n" + RESET)
-            elif r.status_code == 400:
+            elif status_code == 400:
                 raise InvalidAppIdError("Invalid app id.\n" + RESET)
             else:
                 logger.info(f"Logged: OK")
         elif (
             epoint in ["track/getFileUrl", "favorite/getUserFavorites"]
-            and r.status_code == 400
+            and status_code == 400
         ):
-            raise InvalidAppSecretError(f"Invalid app secret: {r.json()}.\n" + RESET)
-
-        r.raise_for_status()
-        return r.json()
+            raise InvalidAppSecretError(
+                f"Invalid app secret: {get_json()}.\n" + RESET
+            )
 
     def auth(self, email, pwd):
-        usr_info = self.api_call("user/login", email=email, pwd=pwd)
+        self._login(email=email, pwd=pwd)
+        self.restored = False
+        logger.info(f"Membership: {self.label}")
+        self.save_session()
+
+    def _login(self, **kwargs):
+        usr_info = self.api_call("user/login", **kwargs)
         if not usr_info["user"]["credential"]["parameters"]:
             raise IneligibleError("Free accounts are not eligible to download tracks.")
         self.uat = usr_info["user_auth_token"]
         self.session.headers.update({"X-User-Auth-Token": self.uat})
+        self.user_id = usr_info["user"]["id"]
         self.label = usr_info["user"]["credential"]["parameters"]["short_label"]
-        logger.info(f"Membership: {self.label}")
+
+    def load_session(self) -> bool:
+        """Logs in with the user token saved for this account by a previous
+        run, which checks the subscription without sending the password.
+        A 401 from any later call triggers a full login.
+        """
+        if not self.session_file:
+            return False
+        try:
+            with open(self.session_file) as f:
+                saved = json.load(f)
+            if saved["email"] != self._email or saved["app_id"] != self.id:
+                return False
+            self._login(user_id=saved["user_id"], uat=saved["user_auth_token"])
+        except (OSError, ValueError, KeyError, AuthenticationError):
+            return False
+        self.restored = True
+        logger.info(f"Membership: {self.label} (saved session)")
+        return True
+
+    def save_session(self):
+        if not self.session_file:
+            return
+        saved = {
+            "email": self._email,
+            "app_id": self.id,
+            "user_id": self.user_id,
+            "user_auth_token": self.uat,
+        }
+        # the token grants access to the account: keep it private to the user
+        fd = os.open(self.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(saved, f)
 
     def multi_meta(self, epoint, key, id, type):
-        total = 1
-        offset = 0
-        while total > 0:
-            if type in ["tracks", "albums"]:
-                j = self.api_call(epoint, id=id, offset=offset, type=type)[type]
-            else:
-                j = self.api_call(epoint, id=id, offset=offset, type=type)
-            if offset == 0:
-                yield j
-                total = j[key] - 500
-            else:
-                yield j
-                total -= 500
-            offset += 500
+        """Yields every page of a paginated endpoint, in order.
+
+        The first page tells how many items there are; the remaining pages
+        are then fetched in the background, up to PAGE_WORKERS at a time,
+        while the caller works on the pages already yielded.
+        """
+
+        def get_page(offset):
+            j = self.api_call(epoint, id=id, offset=offset, type=type)
+            return j[type] if type in ["tracks", "albums"] else j
+
+        first = get_page(0)
+        offsets = iter(range(PAGE_SIZE, first[key], PAGE_SIZE))
+        pending = deque()
+        pool = ThreadPoolExecutor(max_workers=PAGE_WORKERS)
+        try:
+            # keep a bounded window of requests in flight, ahead of the
+            # page the caller is waiting for. It starts before the first
+            # page is handed over, so the caller can already use it.
+            for offset in offsets:
+                pending.append(pool.submit(get_page, offset))
+                if len(pending) >= PAGE_WORKERS:
+                    break
+            yield first
+            while pending:
+                page = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(pool.submit(get_page, offset))
+                yield page
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
 
     def get_album_meta(self, id):
         return self.api_call("album/get", id=id)
@@ -151,7 +284,20 @@ class Client:
         return self.api_call("track/get", id=id)
 
     def get_track_url(self, id, fmt_id):
-        return self.api_call("track/getFileUrl", id=id, fmt_id=fmt_id)
+        sec = self.sec
+        try:
+            r = self.api_call("track/getFileUrl", id=id, fmt_id=fmt_id, sec=sec)
+        except InvalidAppSecretError:
+            if self.sec_verified and self.sec == sec:
+                raise
+            with self._sec_lock:
+                # another thread may have found a new secret meanwhile
+                if self.sec == sec:
+                    logger.info(f"Stored app secret was rejected. Probing...")
+                    self.cfg_setup()
+            return self.api_call("track/getFileUrl", id=id, fmt_id=fmt_id)
+        self.sec_verified = True
+        return r
 
     def get_artist_meta(self, id):
         return self.multi_meta("artist/get", "albums_count", id, None)
@@ -203,14 +349,39 @@ class Client:
             return False
 
     def cfg_setup(self):
-        for secret in self.secrets:
-            # Falsy secrets
-            if not secret:
-                continue
-
-            if self.test_secret(secret):
-                self.sec = secret
-                break
+        """Finds a working app secret by probing all candidates at once. If
+        none works, asks `refresh_secrets` for new ones and tries again.
+        """
+        self._probe_secrets()
+        if self.sec is None and self.refresh_secrets is not None:
+            app_id, self.secrets = self.refresh_secrets()
+            if str(app_id) != self.id:
+                self.id = str(app_id)
+                self.session.headers.update({"X-App-Id": self.id})
+                # the user token belongs to the old app ID
+                self.auth(self._email, self._pwd)
+            self._probe_secrets()
 
         if self.sec is None:
             raise InvalidAppSecretError("Can't find any valid app secret.\n" + RESET)
+        self.sec_verified = True
+
+    def _probe_secrets(self):
+        # Falsy secrets
+        secrets = [secret for secret in self.secrets if secret]
+        self.sec = None
+        if secrets:
+            pool = ThreadPoolExecutor(max_workers=len(secrets))
+            futures = {pool.submit(self.test_secret, sec): sec for sec in secrets}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        valid = future.result()
+                    except Exception as e:
+                        logger.debug(f"Error testing app secret: {e}")
+                        continue
+                    if valid:
+                        self.sec = futures[future]
+                        break
+            finally:
+                pool.shutdown(wait=False)
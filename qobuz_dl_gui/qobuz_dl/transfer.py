@@ -0,0 +1,171 @@
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 16
+# bounds of the adaptive read size used by `copy_response`
+MIN_CHUNK = 64 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# reads faster than this grow the chunk, slower ones shrink it (seconds)
+FAST_READ, SLOW_READ = 0.05, 0.5
+# minimum seconds between two progress callbacks
+PROGRESS_INTERVAL = 0.2
+
+
+class TransferSession:
+    """Keep-alive HTTP session shared by every file transfer (tracks,
+    covers, booklets), so consecutive downloads from the CDN reuse open
+    connections instead of doing a new TCP/TLS handshake each time.
+
+    :param int pool_size: connections kept open per host; should match the
+    number of transfers running at the same time
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        self.session = requests.Session()
+        self.pool_size = 0
+        self._lock = threading.Lock()
+        # counters of pools that were already dropped by urllib3
+        self._closed_connections = 0
+        self._closed_requests = 0
+        self.resize(pool_size)
+
+    def resize(self, pool_size: int):
+        """Grows the connection pool to at least `pool_size` connections"""
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            connections, requests_ = self._pool_counters()
+            self._closed_connections += connections
+            self._closed_requests += requests_
+            adapter = HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False
+            )
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+            self.pool_size = pool_size
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def warm_up(self, url):
+        """Opens a connection to the host of `url` ahead of its transfer,
+        unless an idle one is already waiting in the pool.
+        """
+        parsed = urlparse(url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        for pool in self._pools():
+            idle = getattr(pool, "pool", None)
+            if (
+                (pool.host, pool.port) == (parsed.hostname, port)
+                and idle is not None
+                and any(conn is not None for conn in list(idle.queue))
+            ):
+                return
+        try:
+            # not streamed, so the connection goes back to the pool
+            self.session.head(url, allow_redirects=True, timeout=10)
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"Connection warm-up failed: {e}")
+
+    def _pools(self):
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    yield pool
+
+    def _pool_counters(self):
+        connections = requests_ = 0
+        for pool in self._pools():
+            connections += pool.num_connections
+            requests_ += pool.num_requests
+        return connections, requests_
+
+    def stats(self) -> dict:
+        """Returns how many connections were opened (handshakes) and how many
+        requests reused an already open one.
+        """
+        with self._lock:
+            connections, requests_ = self._pool_counters()
+        connections += self._closed_connections
+        requests_ += self._closed_requests
+        return {
+            "handshakes": connections,
+            "requests": requests_,
+            "reused": max(requests_ - connections, 0),
+        }
+
+
+def copy_response(response, file, progress=None) -> int:
+    """Writes the body of a streamed response to `file`.
+
+    Data is read straight from the urllib3 stream into one preallocated
+    buffer that is reused for the whole transfer. The read size adapts to
+    the link speed between MIN_CHUNK and MAX_CHUNK, and `progress` is called
+    with the number of new bytes at most every PROGRESS_INTERVAL seconds.
+
+    :param requests.Response response: response opened with stream=True
+    :param file: binary file object
+    :param progress: optional callable taking a byte count
+    :returns: number of bytes written
+    """
+    if response.headers.get("content-encoding", "identity") != "identity":
+        # the raw stream would be compressed
+        written = 0
+        for data in response.iter_content(chunk_size=MIN_CHUNK):
+            written += file.write(data)
+            if progress is not None:
+                progress(len(data))
+        return written
+
+    buffer = memoryview(bytearray(MAX_CHUNK))
+    chunk = MIN_CHUNK
+    written = unreported = 0
+    last_report = time.monotonic()
+    while True:
+        start = time.monotonic()
+        size = response.raw.readinto(buffer[:chunk])
+        if not size:
+            break
+        file.write(buffer[:size])
+        written += size
+        unreported += size
+
+        now = time.monotonic()
+        if now - start < FAST_READ and size == chunk:
+            chunk = min(chunk * 2, MAX_CHUNK)
+        elif now - start > SLOW_READ:
+            chunk = max(chunk // 2, MIN_CHUNK)
+        if progress is not None and now - last_report >= PROGRESS_INTERVAL:
+            progress(unreported)
+            unreported = 0
+            last_report = now
+
+    if progress is not None and unreported:
+        progress(unreported)
+    return written
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(pool_size: int = None) -> TransferSession:
+    """Returns the shared transfer session, growing its pool to at least
+    `pool_size` connections if given.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = TransferSession(pool_size or DEFAULT_POOL_SIZE)
+    if pool_size:
+        _session.resize(pool_size)
+    return _session
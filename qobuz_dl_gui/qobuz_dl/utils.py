@@ -1,10 +1,12 @@
 # Slightly modified version of qobuz-dl, originally written by vitiko98.
 # All credits to the original author.
+import itertools
 import re
 import string
 import os
 import logging
 import time
+from array import array
 
 from mutagen.mp3 import EasyMP3
 from mutagen.flac import FLAC
@@ -75,8 +77,24 @@ def make_m3u(pl_directory):
             pl.write("\n\n".join(track_list))
 
 
+# album types recognized by `smart_discography_filter`, in title + version
+REMASTER_RE = re.compile(r"(?i)(re)?master(ed)?")
+EXTRA_RE = re.compile(r"(?i)(anniversary|deluxe|live|collector|demo|expanded)")
+# title without the text in parens/brackets
+ESSENCE_RE = re.compile(r"([^\(]+)(?:\s*[\(\[][^\)][\)\]])*")
+
+
+def _essence(title: str) -> str:
+    """Ignore text in parens/brackets, return all lowercase.
+    Used to group two albums that may be named similarly, but not exactly
+    the same.
+    """
+    r = ESSENCE_RE.match(title)
+    return (r.group(1) if r else title).strip().lower()
+
+
 def smart_discography_filter(
-    contents: list, save_space: bool = False, skip_extras: bool = False
+    contents, save_space: bool = False, skip_extras: bool = False
 ) -> list:
     """When downloading some artists' discography, many random and spam-like
     albums can get downloaded. This helps filter those out to just get the good stuff.
@@ -86,82 +104,91 @@ def smart_discography_filter(
         * duplicate albums in different qualities
         * (optionally) removes collector's, deluxe, live albums
 
-    :param list contents: contents returned by qobuz API
+    The pages are read once, in order, and the qualities of the albums are
+    kept in flat columns, so the filter runs in linear time.
+
+    :param contents: pages returned by qobuz API (any iterable)
     :param bool save_space: choose highest bit depth, lowest sampling rate
     :param bool remove_extras: remove albums with extra material (i.e. live, deluxe,...)
     :returns: filtered items list
     """
-
-    # for debugging
-    def print_album(album: dict) -> None:
-        logger.debug(
-            f"{album['title']} - {album.get('version', '~~')} "
-            "({album['maximum_bit_depth']}/{album['maximum_sampling_rate']}"
-            " by {album['artist']['name']}) {album['id']}"
-        )
-
-    TYPE_REGEXES = {
-        "remaster": r"(?i)(re)?master(ed)?",
-        "extra": r"(?i)(anniversary|deluxe|live|collector|demo|expanded)",
-    }
-
-    def is_type(album_t: str, album: dict) -> bool:
-        """Check if album is of type `album_t`"""
-        version = album.get("version", "")
-        title = album.get("title", "")
-        regex = TYPE_REGEXES[album_t]
-        return re.search(regex, f"{title} {version}") is not None
-
-    def essence(album: dict) -> str:
-        """Ignore text in parens/brackets, return all lowercase.
-        Used to group two albums that may be named similarly, but not exactly
-        the same.
-        """
-        r = re.match(r"([^\(]+)(?:\s*[\(\[][^\)][\)\]])*", album)
-        return r.group(1).strip().lower()
-
-    requested_artist = contents[0]["name"]
-    items = [item["albums"]["items"] for item in contents][0]
-
-    # use dicts to group duplicate albums together by title
-    title_grouped = dict()
-    for item in items:
-        title_ = essence(item["title"])
-        if title_ not in title_grouped:  # ?
-            #            if (t := essence(item["title"])) not in title_grouped:
-            title_grouped[title_] = []
-        title_grouped[title_].append(item)
-
-    items = []
-    for albums in title_grouped.values():
-        best_bit_depth = max(a["maximum_bit_depth"] for a in albums)
-        get_best = min if save_space else max
-        best_sampling_rate = get_best(
-            a["maximum_sampling_rate"]
-            for a in albums
-            if a["maximum_bit_depth"] == best_bit_depth
-        )
-        remaster_exists = any(is_type("remaster", a) for a in albums)
-
-        def is_valid(album: dict) -> bool:
-            return (
-                album["maximum_bit_depth"] == best_bit_depth
-                and album["maximum_sampling_rate"] == best_sampling_rate
-                and album["artist"]["name"] == requested_artist
-                and not (  # states that are not allowed
-                    (remaster_exists and not is_type("remaster", album))
-                    or (skip_extras and is_type("extra", album))
+    pages = iter(contents)
+    first = next(pages, None)
+    if first is None:
+        return []
+    requested_artist = first["name"]
+
+    # one entry per album, in discography order
+    albums = []
+    groups = array("l")
+    bit_depths = array("d")
+    sampling_rates = array("d")
+    by_artist = array("b")
+    # one entry per group of albums with the same title essence
+    group_ids = {}
+    remaster_exists = array("b")
+    for page in itertools.chain([first], pages):
+        for album in page["albums"]["items"]:
+            group = group_ids.setdefault(_essence(album["title"]), len(group_ids))
+            if group == len(remaster_exists):
+                remaster_exists.append(0)
+            if not remaster_exists[group] and _is_type(REMASTER_RE, album):
+                remaster_exists[group] = 1
+            albums.append(album)
+            groups.append(group)
+            bit_depths.append(_quality(album["maximum_bit_depth"]))
+            sampling_rates.append(_quality(album["maximum_sampling_rate"]))
+            by_artist.append(album["artist"]["name"] == requested_artist)
+
+    count = len(group_ids)
+    best_bit_depth = array("d", [float("-inf")]) * count
+    for group, bit_depth in zip(groups, bit_depths):
+        if bit_depth > best_bit_depth[group]:
+            best_bit_depth[group] = bit_depth
+
+    # best sampling rate among the albums of the best bit depth
+    worst = float("inf") if save_space else float("-inf")
+    best_sampling_rate = array("d", [worst]) * count
+    for group, bit_depth, sampling_rate in zip(groups, bit_depths, sampling_rates):
+        if bit_depth != best_bit_depth[group]:
+            continue
+        best = best_sampling_rate[group]
+        if sampling_rate < best if save_space else sampling_rate > best:
+            best_sampling_rate[group] = sampling_rate
+
+    # first valid album of each group. If there are more, they are complete
+    # duplicates, so it doesn't matter which is chosen
+    chosen = array("l", [-1]) * count
+    for index, (group, bit_depth, sampling_rate, artist_ok) in enumerate(
+        zip(groups, bit_depths, sampling_rates, by_artist)
+    ):
+        if (
+            chosen[group] == -1
+            and bit_depth == best_bit_depth[group]
+            and sampling_rate == best_sampling_rate[group]
+            and artist_ok
+            and not (  # states that are not allowed
+                (
+                    remaster_exists[group]
+                    and not _is_type(REMASTER_RE, albums[index])
                 )
+                or (skip_extras and _is_type(EXTRA_RE, albums[index]))
             )
+        ):
+            chosen[group] = index
+
+    return [albums[index] for index in chosen if index != -1]
+
+
+def _is_type(regex, album: dict) -> bool:
+    """Check if the title or version of `album` matches `regex`"""
+    text = f"{album.get('title', '')} {album.get('version', '')}"
+    return regex.search(text) is not None
 
-        filtered = tuple(filter(is_valid, albums))
-        # most of the time, len is 0 or 1.
-        # if greater, it is a complete duplicate,
-        # so it doesn't matter which is chosen
-        if len(filtered) >= 1:
-            items.append(filtered[0])
 
-    return items
+def _quality(value) -> float:
+    # missing qualities rank below any known one
+    return -1.0 if value is None else float(value)
 
 
 def format_duration(duration):
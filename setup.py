@@ -11,6 +11,7 @@ def read_file(fname):
 requirements = [
     "pathvalidate",
     "requests",
+    "aiohttp",
     "mutagen",
     "tqdm",
     "pick==1.6.0",
@@ -42,5 +43,5 @@ setup(
         "License :: OSI Approved :: GNU General Public License (GPL)",
         "Operating System :: OS Independent",
     ],
-    python_requires=">=3.6",
+    python_requires=">=3.8",
 )
\ No newline at end of file